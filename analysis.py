@@ -0,0 +1,394 @@
+"""
+Multivariate analysis of whole maps.
+
+The functions here read the cube of a SpectrumCollection (see build_cube)
+a block of X rows at a time, so maps memory-mapped from disk are never
+loaded whole. Per-pixel results are (num_xs, num_ys, ...) arrays in the
+layout of the cube; heatmap() turns one of their slices into the
+orientation of get_heatmap_array for display.
+"""
+import numpy as np
+from parallel import with_progress
+from preprocessing import row_blocks
+from profiling import profiled
+
+
+def heatmap(pixel_map):
+    """Orients a (num_xs, num_ys) per-pixel map like get_heatmap_array"""
+    return np.rot90(pixel_map)
+
+
+def split_progress(progress, part, parts):
+    """Progress callback reporting a pass over the data as part (counted
+    from 0) of parts equal passes"""
+    if progress is None:
+        return None
+    return lambda done, total: progress(part * total + done, parts * total)
+
+
+def valid_spectra(collec, start, stop):
+    """Returns the spectra of the pixels that hold one in X rows start:stop,
+    as an (n, n_wavenums) array, and the mask of those pixels"""
+    mask = collec.mask[start:stop]
+    return np.asarray(collec.cube[start:stop])[mask], mask
+
+
+class PCA(object):
+    """Principal components of the spectra of a map, see pca"""
+
+    def __init__(self, wavenums, mean, components, explained_variance, total_variance,
+                 scores, mask):
+        #: Wavenumber axis of the component spectra
+        self.wavenums = wavenums
+        #: Mean spectrum, subtracted before projecting
+        self.mean = mean
+        #: (n_components, n_wavenums) component spectra, unit length
+        self.components = components
+        #: Variance of the scores along each component
+        self.explained_variance = explained_variance
+        #: Fraction of the total variance along each component
+        self.explained_variance_ratio = explained_variance / (total_variance or 1.0)
+        #: (num_xs, num_ys, n_components) scores, zero where mask is False
+        self.scores = scores
+        self.mask = mask
+
+    def score_map(self, component):
+        """Scores of one component as a heatmap array"""
+        return heatmap(self.scores[:, :, component])
+
+    def reconstruct(self, i, j):
+        """Spectrum at pixel i, j rebuilt from the kept components"""
+        return self.mean + self.scores[i, j].dot(self.components)
+
+
+@profiled()
+def pca(collec, n_components=5, progress=None):
+    """
+    Principal component analysis of every spectrum of collec.
+
+    The first pass over the cube accumulates the sum and the Gram matrix of
+    the spectra block by block; the covariance matrix, n_wavenums square,
+    is then diagonalized. The second pass projects every spectrum on the
+    n_components strongest components. Memory use is bounded by one block
+    and the covariance matrix, whatever the number of spectra.
+    Returns a PCA object. progress(done, total) is called per block.
+    """
+    if collec.cube is None:
+        collec.build_cube()
+    blocks = row_blocks(collec)
+    n_wavenums = len(collec.wavenums)
+    n_components = min(n_components, n_wavenums)
+
+    # Spectra are shifted by the mean of the first block before accumulating,
+    # so the Gram matrix does not lose the variance to a large common background
+    shift = None
+    count = 0
+    total = np.zeros(n_wavenums)
+    gram = np.zeros((n_wavenums, n_wavenums))
+    for start, stop in with_progress(blocks, len(blocks), split_progress(progress, 0, 2)):
+        spectra, _ = valid_spectra(collec, start, stop)
+        if not len(spectra):
+            continue
+        if shift is None:
+            shift = spectra.mean(axis=0)
+        spectra = spectra - shift
+        count += len(spectra)
+        total += spectra.sum(axis=0)
+        gram += spectra.T.dot(spectra)
+    if count < 2:
+        raise ValueError("PCA needs at least two spectra")
+
+    mean = total / count
+    covariance = (gram - count * np.outer(mean, mean)) / (count - 1)
+    variances, vectors = np.linalg.eigh(covariance)
+    # eigh sorts ascending, keep the strongest components first
+    order = np.argsort(variances)[::-1][:n_components]
+    components = vectors[:, order].T
+    # Fix the arbitrary sign, largest coefficient positive
+    signs = np.sign(components[np.arange(n_components), np.abs(components).argmax(axis=1)])
+    components *= signs[:, np.newaxis]
+    mean += shift
+
+    scores = np.zeros((collec.num_xs, collec.num_ys, n_components))
+    for start, stop in with_progress(blocks, len(blocks), split_progress(progress, 1, 2)):
+        spectra, mask = valid_spectra(collec, start, stop)
+        scores[start:stop][mask] = (spectra - mean).dot(components.T)
+    return PCA(np.array(collec.wavenums), mean, components,
+               np.clip(variances[order], 0, None), max(np.trace(covariance), 0),
+               scores, np.array(collec.mask))
+
+
+#: Spectrum normalizations accepted by normalize
+NORMALIZATIONS = (None, "area", "max", "l2", "snv")
+
+
+def normalize(spectra, method=None):
+    """
+    Normalizes the rows of an (n, n_wavenums) array of spectra: "area"
+    divides by the summed absolute intensity, "max" by the largest absolute
+    intensity, "l2" by the Euclidean norm and "snv" (standard normal
+    variate) subtracts the mean and divides by the standard deviation.
+    None returns the spectra unchanged.
+    """
+    if method is None:
+        return spectra
+    if method == "snv":
+        spectra = spectra - spectra.mean(axis=1)[:, np.newaxis]
+        scale = spectra.std(axis=1)
+    elif method == "area":
+        scale = np.abs(spectra).sum(axis=1)
+    elif method == "max":
+        scale = np.abs(spectra).max(axis=1)
+    elif method == "l2":
+        scale = np.sqrt((spectra ** 2).sum(axis=1))
+    else:
+        raise ValueError("Unknown normalization {!r}, expected one of {}".format(
+            method, NORMALIZATIONS))
+    # Flat spectra are left at their (shifted) values instead of dividing by zero
+    scale[scale == 0] = 1.0
+    return spectra / scale[:, np.newaxis]
+
+
+def squared_distances(spectra, centroids):
+    """(n, k) squared Euclidean distances between rows of spectra and of
+    centroids, without forming the (n, k, n_wavenums) differences"""
+    distances = ((spectra ** 2).sum(axis=1)[:, np.newaxis] - 2 * spectra.dot(centroids.T) +
+                 (centroids ** 2).sum(axis=1)[np.newaxis, :])
+    return np.maximum(distances, 0, out=distances)
+
+
+def sample_spectra(collec, pixels, norm=None):
+    """Normalized spectra of the pixels at the given flat cube indices"""
+    i, j = np.unravel_index(np.sort(pixels), (collec.num_xs, collec.num_ys))
+    return normalize(np.asarray(collec.cube[i, j], dtype=float), norm)
+
+
+def cluster_sums(labels, spectra, k):
+    """(k, n_wavenums) sums of the spectra with each label, as one matrix
+    product with the one-hot label matrix"""
+    return (labels == np.arange(k)[:, np.newaxis]).astype(spectra.dtype).dot(spectra)
+
+
+def kmeans_plus_plus(spectra, k, rng):
+    """Picks k initial centroids among spectra by k-means++ seeding"""
+    centroids = [spectra[rng.randint(len(spectra))]]
+    closest = squared_distances(spectra, np.array(centroids))[:, 0]
+    for _ in range(1, k):
+        total = closest.sum()
+        if total > 0:
+            pick = np.searchsorted(np.cumsum(closest), rng.uniform(0, total))
+        else:
+            # All remaining spectra coincide with a centroid
+            pick = rng.randint(len(spectra))
+        centroids.append(spectra[min(pick, len(spectra) - 1)])
+        closest = np.minimum(closest, squared_distances(spectra, centroids[-1][np.newaxis])[:, 0])
+    return np.array(centroids)
+
+
+class Clusters(object):
+    """Segmentation of a map into clusters of similar spectra, see kmeans"""
+
+    def __init__(self, wavenums, labels, centroids, mean_spectra, counts, inertia, norm):
+        #: Wavenumber axis of the centroid spectra
+        self.wavenums = wavenums
+        #: (num_xs, num_ys) cluster of every pixel, -1 where there is no spectrum
+        self.labels = labels
+        #: (k, n_wavenums) cluster centres, in normalized units
+        self.centroids = centroids
+        #: (k, n_wavenums) mean of the spectra of each cluster, in the units of the data
+        self.mean_spectra = mean_spectra
+        #: Number of spectra in each cluster
+        self.counts = counts
+        #: Sum of squared distances of the spectra to their centroid
+        self.inertia = inertia
+        self.norm = norm
+
+    def label_map(self):
+        """Cluster labels as a heatmap array"""
+        return heatmap(self.labels)
+
+
+@profiled()
+def kmeans(collec, k=5, norm=None, batch_size=1024, max_iter=200, tol=1e-4, seed=0,
+           progress=None):
+    """
+    Mini-batch k-means clustering of every spectrum of collec.
+
+    Spectra are normalized (see normalize) and clustered in random batches
+    of batch_size pixels read from the cube: each batch is assigned to its
+    nearest centroids and every centroid moves to the running mean of the
+    spectra assigned to it so far. Iteration stops after max_iter batches
+    or once no centroid moves by more than tol relative to the spread of
+    the data. A last pass over the cube labels every pixel. Only a batch
+    and the (batch_size, k) distances are ever held in memory.
+    Returns a Clusters object. progress(done, total) is called per batch
+    and per block of the labeling pass.
+    """
+    if norm not in NORMALIZATIONS:
+        raise ValueError("Unknown normalization {!r}, expected one of {}".format(
+            norm, NORMALIZATIONS))
+    if collec.cube is None:
+        collec.build_cube()
+    rng = np.random.RandomState(seed)
+    pixels = np.flatnonzero(collec.mask)
+    if len(pixels) < k:
+        raise ValueError("Cannot make {} clusters out of {} spectra".format(k, len(pixels)))
+    batch_size = min(batch_size, len(pixels))
+
+    seeds = sample_spectra(collec, rng.choice(pixels, min(len(pixels), max(batch_size, 10 * k)),
+                                              replace=False), norm)
+    centroids = kmeans_plus_plus(seeds, k, rng)
+    scale = max(seeds.var(axis=0).sum(), np.finfo(float).tiny)
+    counts = np.zeros(k)
+    for _ in with_progress(range(max_iter), max_iter, split_progress(progress, 0, 2)):
+        batch = sample_spectra(collec, rng.choice(pixels, batch_size, replace=False), norm)
+        labels = squared_distances(batch, centroids).argmin(axis=1)
+        members = np.bincount(labels, minlength=k)
+        sums = cluster_sums(labels, batch, k)
+        counts += members
+        hit = members > 0
+        moved = centroids.copy()
+        # Running mean: the same as moving by 1 / count once per spectrum
+        moved[hit] += (sums[hit] - members[hit, np.newaxis] * centroids[hit]) / \
+            counts[hit, np.newaxis]
+        shift = ((moved - centroids) ** 2).sum()
+        centroids = moved
+        if shift <= tol * scale:
+            break
+
+    labels_map = np.full((collec.num_xs, collec.num_ys), -1, dtype=int)
+    mean_spectra = np.zeros_like(centroids)
+    sizes = np.zeros(k, dtype=int)
+    inertia = 0.0
+    blocks = row_blocks(collec)
+    for start, stop in with_progress(blocks, len(blocks), split_progress(progress, 1, 2)):
+        spectra, mask = valid_spectra(collec, start, stop)
+        if not len(spectra):
+            continue
+        distances = squared_distances(normalize(spectra, norm), centroids)
+        labels = distances.argmin(axis=1)
+        labels_map[start:stop][mask] = labels
+        inertia += distances[np.arange(len(labels)), labels].sum()
+        sizes += np.bincount(labels, minlength=k)
+        mean_spectra += cluster_sums(labels, spectra, k)
+    mean_spectra /= np.maximum(sizes, 1)[:, np.newaxis]
+    return Clusters(np.array(collec.wavenums), labels_map, centroids, mean_spectra, sizes,
+                    inertia, norm)
+
+
+#: Per-pixel maps made by find_peaks
+PEAK_PARAMETERS = ("position", "height", "fwhm", "area")
+
+
+class Peaks(object):
+    """Parameters of the strongest peak of every spectrum in a wavenumber
+    window, see find_peaks"""
+
+    def __init__(self, wnum_1, wnum_2, maps):
+        self.window = (wnum_1, wnum_2)
+        #: (num_xs, num_ys) maps of peak position, height above the local
+        #: baseline, full width at half maximum and baseline corrected area,
+        #: NaN where there is no spectrum or no peak inside the window
+        self.position = maps["position"]
+        self.height = maps["height"]
+        self.fwhm = maps["fwhm"]
+        self.area = maps["area"]
+
+    def map(self, parameter):
+        """One of PEAK_PARAMETERS as a heatmap array"""
+        if parameter not in PEAK_PARAMETERS:
+            raise ValueError("Unknown peak parameter {!r}, expected one of {}".format(
+                parameter, PEAK_PARAMETERS))
+        return heatmap(getattr(self, parameter))
+
+
+def parabola_vertex(x, y):
+    """Vertex of the parabolas through the three points x[:, k], y[:, k]
+    (k = 0, 1, 2) of every row, computed relative to the middle point.
+    Rows that are not concave keep the middle point."""
+    u0, u2 = x[:, 0] - x[:, 1], x[:, 2] - x[:, 1]
+    d0, d2 = y[:, 0] - y[:, 1], y[:, 2] - y[:, 1]
+    # y - y1 = a u^2 + b u through (u0, d0) and (u2, d2)
+    denom = u0 * u2 * (u0 - u2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = (d0 * u2 - d2 * u0) / denom
+        b = (d2 * u0 ** 2 - d0 * u2 ** 2) / denom
+        concave = a < 0
+        offset = np.where(concave, -b / (2 * a), 0.0)
+    offset = np.clip(offset, u0, u2)
+    return x[:, 1] + offset, y[:, 1] + np.where(concave, a * offset ** 2 + b * offset, 0.0)
+
+
+def fit_peaks(wavenums, spectra, baseline=True):
+    """
+    Finds the strongest peak of every row of spectra, sampled at the
+    increasing wavenums. The position and height come from a parabola
+    through the highest point and its neighbours; with baseline, heights,
+    widths and areas are measured above the straight line joining the
+    first and last point. Rows whose maximum lies on the window edge have
+    no peak and get NaN. Returns a dict of PEAK_PARAMETERS arrays.
+    """
+    n, m = spectra.shape
+    rows = np.arange(n)
+    if baseline:
+        slope = (spectra[:, -1] - spectra[:, 0]) / (wavenums[-1] - wavenums[0])
+        signal = spectra - (spectra[:, :1] + slope[:, np.newaxis] * (wavenums - wavenums[0]))
+    else:
+        signal = spectra
+    top = signal.argmax(axis=1)
+    inside = (top > 0) & (top < m - 1)
+    centre = np.clip(top, 1, m - 2)
+    neighbours = centre[:, np.newaxis] + np.arange(-1, 2)
+    position, height = parabola_vertex(wavenums[neighbours], signal[rows[:, np.newaxis], neighbours])
+
+    # Half maximum crossings, interpolated between the samples around them
+    below = signal < (height / 2)[:, np.newaxis]
+    columns = np.arange(m)
+    left = np.where(below & (columns < top[:, np.newaxis]), columns, -1).max(axis=1)
+    right = np.where(below & (columns > top[:, np.newaxis]), columns, m).min(axis=1)
+    crossed = inside & (left >= 0) & (right < m)
+    left, right = np.clip(left, 0, m - 2), np.clip(right, 1, m - 1)
+    half = height / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        left_x = wavenums[left] + (half - signal[rows, left]) * \
+            (wavenums[left + 1] - wavenums[left]) / (signal[rows, left + 1] - signal[rows, left])
+        right_x = wavenums[right - 1] + (half - signal[rows, right - 1]) * \
+            (wavenums[right] - wavenums[right - 1]) / (signal[rows, right] - signal[rows, right - 1])
+    fwhm = np.where(crossed, right_x - left_x, np.nan)
+
+    area = ((signal[:, 1:] + signal[:, :-1]) * np.diff(wavenums) / 2).sum(axis=1)
+    return {"position": np.where(inside, position, np.nan),
+            "height": np.where(inside, height, np.nan),
+            "fwhm": fwhm,
+            "area": np.where(inside, area, np.nan)}
+
+
+@profiled()
+def find_peaks(collec, wnum_1, wnum_2, baseline=True, progress=None):
+    """
+    Measures the strongest peak between wnum_1 and wnum_2 in every spectrum
+    of collec (see fit_peaks), reading only that window of the cube, a
+    block of X rows at a time. Returns a Peaks object.
+    progress(done, total) is called per block.
+    """
+    if collec.cube is None:
+        collec.build_cube()
+    wavenums = np.asarray(collec.wavenums)
+    low, high = min(wnum_1, wnum_2), max(wnum_1, wnum_2)
+    window = np.flatnonzero((wavenums >= low) & (wavenums <= high))
+    if len(window) < 3:
+        raise ValueError("Need at least three wavenumbers between {} and {}".format(low, high))
+    # Columns of the window within the slice first:last + 1, by increasing wavenum
+    first, last = window.min(), window.max()
+    columns = window[np.argsort(wavenums[window], kind='mergesort')] - first
+    maps = dict((name, np.full((collec.num_xs, collec.num_ys), np.nan))
+                for name in PEAK_PARAMETERS)
+    blocks = row_blocks(collec)
+    for start, stop in with_progress(blocks, len(blocks), progress):
+        mask = collec.mask[start:stop]
+        spectra = np.asarray(collec.cube[start:stop, :, first:last + 1])[mask][:, columns]
+        if not len(spectra):
+            continue
+        for name, values in fit_peaks(wavenums[columns + first], spectra, baseline).items():
+            maps[name][start:stop][mask] = values
+    return Peaks(low, high, maps)
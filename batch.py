@@ -0,0 +1,248 @@
+"""
+Headless batch processing of scan directories.
+
+Every directory given on the command line is loaded (area scan or
+linescan, detected from its files), optionally baseline corrected and
+Savitzky-Golay filtered, and its band heatmaps and image stack are written
+to an output directory. Several directories are processed at once, one per
+worker process, and a JSON manifest of the run lists what was written for
+each of them. Qt is never imported and no window is opened.
+
+    python batch.py scans/* --band 1300:1700 --band 2800:3000 -j 8
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import traceback
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+# Nothing here draws on screen, keep matplotlib off any GUI backend
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+#: Directory created in each scan directory when no --output is given
+OUTPUT_DIR = "pyspectrum_batch"
+
+
+def scan_kind(path):
+    """Returns "linescan" for a directory holding a single file without X/Y
+    coordinates in its name, "area" otherwise"""
+    from pyspec import XY_PATTERN
+    from scan_cache import scan_files
+    files = scan_files(path)
+    if len(files) == 1 and not XY_PATTERN.search(files[0]):
+        return "linescan"
+    return "area"
+
+
+def output_dir(path, output):
+    """Output directory of the scan directory path"""
+    if output is None:
+        return os.path.join(path, OUTPUT_DIR)
+    return os.path.join(output, os.path.basename(os.path.normpath(path)))
+
+
+def process_directory(path, options, processes=None):
+    """
+    Loads, corrects and exports one scan directory as described by options
+    (the parsed command line as a dict). Returns its manifest entry; errors
+    are recorded in the entry rather than raised, so one bad directory does
+    not stop the batch.
+    """
+    from scan_cache import load_scan
+    from preprocessing import rubberband_correct, savgol
+    from export import export_stack, save_heatmap
+
+    entry = {"path": os.path.abspath(path), "status": "failed", "outputs": [], "timings": {}}
+    start = time.time()
+
+    def timed(name, func, *args, **kwargs):
+        stage_start = time.time()
+        result = func(*args, **kwargs)
+        entry["timings"][name] = time.time() - stage_start
+        return result
+
+    try:
+        kind = options["kind"] or scan_kind(path)
+        linescan = kind == "linescan"
+        entry["kind"] = kind
+        out_dir = output_dir(path, options["output"])
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        entry["output_dir"] = os.path.abspath(out_dir)
+
+        collec = timed("load", load_scan, path, linescan, use_cache=options["cache"],
+                       processes=processes, compact=options["compact"])
+        entry["spectra"] = len(collec.spectra)
+        entry["shape"] = [collec.num_xs, collec.num_ys]
+
+        if options["baseline"]:
+            if collec.cube is None:
+                entry["baseline"] = "skipped, spectra do not share a wavenumber axis"
+            else:
+                # Out of core scans get their corrected cube on disk as well
+                cube_file = None
+                if isinstance(collec.cube, np.memmap):
+                    cube_file = os.path.join(out_dir, "corrected_cube.npy")
+                collec = timed("baseline", rubberband_correct, collec, processes, cube_file)
+                entry["baseline"] = "rubberband"
+
+        if options["savgol"]:
+            if collec.cube is None:
+                entry["savgol"] = "skipped, spectra do not share a wavenumber axis"
+            else:
+                window, polyorder, deriv = options["savgol"]
+                cube_file = None
+                if isinstance(collec.cube, np.memmap):
+                    cube_file = os.path.join(out_dir, "savgol_cube.npy")
+                collec = timed("savgol", savgol, collec, window, polyorder, deriv, processes,
+                               cube_file)
+                entry["savgol"] = "window {}, polyorder {}, deriv {}".format(
+                    window, polyorder, deriv)
+
+        aspect = 0.1 if linescan else None
+        for wnum_1, wnum_2 in options["bands"]:
+            name = "heatmap_{:g}_{:g}".format(wnum_1, wnum_2)
+            heatmap_array = timed(name, collec.get_heatmap_array, wnum_1, wnum_2)
+            np.save(os.path.join(out_dir, name + ".npy"), heatmap_array)
+            save_heatmap(heatmap_array, os.path.join(out_dir, name + ".png"), aspect=aspect)
+            entry["outputs"] += [name + ".npy", name + ".png"]
+
+        if options["stack"]:
+            stack_dir = os.path.join(out_dir, "stack")
+            if not os.path.exists(stack_dir):
+                os.makedirs(stack_dir)
+            written = timed("stack", export_stack, collec, stack_dir, linescan=linescan,
+                            cmap=options["cmap"], multipage=options["multipage"],
+                            threads=processes, aspect=aspect)
+            entry["outputs"] += [os.path.relpath(filename, out_dir) for filename in written]
+        entry["status"] = "ok"
+    except Exception:
+        entry["error"] = traceback.format_exc()
+    entry["seconds"] = time.time() - start
+    return entry
+
+
+def _process_directory(args):
+    """Pool worker: processes one directory without nested pools"""
+    path, options = args
+    return process_directory(path, options, processes=1)
+
+
+def run_batch(paths, options, jobs=None, verbose=True):
+    """Processes every directory in paths, jobs of them at a time (all
+    cores by default). Returns the manifest entries in the order of paths."""
+    jobs = min(jobs or cpu_count(), len(paths))
+    entries = {}
+
+    def report(entry):
+        entries[entry["path"]] = entry
+        if verbose:
+            print("[{}/{}] {} {} ({:.1f} s)".format(len(entries), len(paths), entry["status"],
+                                                  entry["path"], entry["seconds"]))
+            if entry["status"] != "ok":
+                print(entry["error"], file=sys.stderr)
+
+    if jobs <= 1:
+        # A single directory gets the worker pools of the loader itself
+        for path in paths:
+            report(process_directory(path, options))
+    else:
+        pool = Pool(jobs)
+        try:
+            for entry in pool.imap_unordered(_process_directory,
+                                             [(path, options) for path in paths]):
+                report(entry)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return [entries[os.path.abspath(path)] for path in paths]
+
+
+def parse_savgol(text):
+    """Parses Savitzky-Golay options given as 'window[:polyorder[:deriv]]'"""
+    try:
+        values = [int(part) for part in text.split(":")]
+    except ValueError:
+        values = []
+    if not 1 <= len(values) <= 3:
+        raise argparse.ArgumentTypeError(
+            "savgol must look like 11, 11:3 or 11:3:1, not {!r}".format(text))
+    return tuple(values + [3, 0][len(values) - 1:])
+
+
+def parse_band(text):
+    """Parses a band given as 'wnum_1:wnum_2'"""
+    try:
+        wnum_1, wnum_2 = (float(part) for part in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("band must look like 1300:1700, not {!r}".format(text))
+    return min(wnum_1, wnum_2), max(wnum_1, wnum_2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("paths", nargs="+", metavar="DIR", help="scan directories")
+    parser.add_argument("-b", "--band", dest="bands", action="append", type=parse_band,
+                        default=[], metavar="W1:W2",
+                        help="wavenumber band of a heatmap, may be repeated")
+    parser.add_argument("-o", "--output",
+                        help="write the results of each directory into OUTPUT/<name> "
+                             "instead of <dir>/" + OUTPUT_DIR)
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="directories processed at once (default all cores)")
+    parser.add_argument("--linescan", dest="kind", action="store_const", const="linescan",
+                        help="treat every directory as a linescan")
+    parser.add_argument("--area", dest="kind", action="store_const", const="area",
+                        help="treat every directory as an area scan")
+    parser.add_argument("--no-baseline", dest="baseline", action="store_false",
+                        help="skip the rubberband baseline correction")
+    parser.add_argument("--savgol", type=parse_savgol, metavar="W[:P[:D]]",
+                        help="Savitzky-Golay filter after the baseline: window W, polynomial "
+                             "order P (default 3), derivative D (default 0, 1 or 2)")
+    parser.add_argument("--no-stack", dest="stack", action="store_false",
+                        help="skip the image stack export")
+    parser.add_argument("--multipage", action="store_const", const="stack.tiff",
+                        help="write the stack as one multipage TIFF")
+    parser.add_argument("--cmap", default="gray", help="colormap of the stack images")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="do not read or write the scan cache")
+    parser.add_argument("--compact", action="store_true",
+                        help="hold the spectra as float32, without per-spectrum objects")
+    parser.add_argument("--manifest", help="manifest file (default batch_<time>.json)")
+    args = parser.parse_args(argv)
+
+    paths = [path for path in args.paths if os.path.isdir(path)]
+    for path in set(args.paths) - set(paths):
+        print("Skipping {}, not a directory".format(path), file=sys.stderr)
+    options = {"kind": args.kind, "bands": args.bands, "output": args.output,
+               "baseline": args.baseline, "savgol": args.savgol, "stack": args.stack,
+               "multipage": args.multipage, "cmap": args.cmap, "cache": args.cache,
+               "compact": args.compact}
+
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    start = time.time()
+    entries = run_batch(paths, options, args.jobs) if paths else []
+    manifest = {"started": started, "seconds": time.time() - start,
+                "command": sys.argv if argv is None else ["batch.py"] + list(argv),
+                "options": options, "host": platform.node(), "directories": entries}
+
+    manifest_file = args.manifest or "batch_{}.json".format(time.strftime("%Y%m%d_%H%M%S"))
+    with open(manifest_file, "w") as out:
+        json.dump(manifest, out, indent=2)
+    failed = sum(entry["status"] != "ok" for entry in entries)
+    print("{} directories processed, {} failed, manifest written to {}".format(
+        len(entries), failed, manifest_file))
+    return 1 if failed or len(paths) < len(args.paths) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+"""
+Benchmarks of the main data paths on synthetic Raman scans.
+
+Writes an area scan directory (one file per point, named like the
+instrument does) and a linescan file of the requested sizes, times the
+loading, image, heatmap, export and baseline stages on them and saves the
+timings as JSON, along with the memory and heatmap accuracy of compact
+(float32) storage and the spikes despiking finds and invents. Runs
+headless, matplotlib is switched to the Agg backend.
+
+    python benchmark.py --size medium -o before.json
+    python benchmark.py --size medium -o after.json --compare before.json
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from multiprocessing import cpu_count
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+#: (num_xs, num_ys, num_wavenums) of the area scan for each --size
+SIZES = {
+    "small": (20, 20, 200),
+    "medium": (60, 60, 500),
+    "large": (150, 150, 1000),
+}
+
+#: Raman shift range of the synthetic spectra, in 1/cm
+WAVENUM_RANGE = (100.0, 3200.0)
+
+#: Band centres and widths of the synthetic spectra, in 1/cm
+BANDS = [(465.0, 12.0), (1085.0, 8.0), (1350.0, 40.0), (1600.0, 30.0), (2900.0, 25.0)]
+
+
+def synthetic_spectra(num_spectra, num_wavenums, seed=0):
+    """Returns the wavenum axis and a (num_spectra, num_wavenums) array of
+    Raman-like spectra: Lorentzian bands of varying strength on a sloped
+    fluorescence background, plus noise"""
+    rng = np.random.RandomState(seed)
+    wavenums = np.linspace(WAVENUM_RANGE[0], WAVENUM_RANGE[1], num_wavenums)
+    span = WAVENUM_RANGE[1] - WAVENUM_RANGE[0]
+    background = (rng.uniform(50, 200, (num_spectra, 1)) *
+                  np.exp(-(wavenums - WAVENUM_RANGE[0]) / (rng.uniform(0.5, 2, (num_spectra, 1)) * span)))
+    intens = background + rng.normal(0, 2, (num_spectra, num_wavenums))
+    for centre, width in BANDS:
+        heights = rng.uniform(0, 500, (num_spectra, 1))
+        intens += heights / (1 + ((wavenums - centre) / width) ** 2)
+    return wavenums, intens
+
+
+def make_area_scan(path, num_xs, num_ys, num_wavenums, seed=0):
+    """Writes an area scan directory of num_xs * num_ys spectrum files"""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    wavenums, intens = synthetic_spectra(num_xs * num_ys, num_wavenums, seed)
+    k = 0
+    for i in range(num_xs):
+        for j in range(num_ys):
+            name = "map_X_{:+.4f}_Y_{:+.4f}.txt".format(-50.0 + 0.5 * i, 20.0 + 0.5 * j)
+            # The instrument writes the spectra from high to low wavenumber
+            np.savetxt(os.path.join(path, name),
+                       np.column_stack((wavenums, intens[k]))[::-1],
+                       fmt="%.4f", delimiter="\t")
+            k += 1
+
+
+def make_linescan(filename, num_points, num_wavenums, seed=0):
+    """Writes a linescan file of num_points spectra"""
+    wavenums, intens = synthetic_spectra(num_points, num_wavenums, seed)
+    with open(filename, "w") as linefile:
+        for k in range(num_points):
+            rows = np.column_stack((np.full(num_wavenums, 0.5 * k), np.full(num_wavenums, 20.0),
+                                    wavenums[::-1], intens[k][::-1]))
+            np.savetxt(linefile, rows, fmt="%.4f", delimiter="\t")
+
+
+def measure(func, repeat):
+    """Calls func repeat times, returns the wall times in seconds and the
+    last return value"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        result = func()
+        times.append(timeit.default_timer() - start)
+    return times, result
+
+
+def check_compact(collec, compact, bands):
+    """Compares the heatmaps of a compact collection with those of the same
+    data at full precision, and the memory both hold"""
+    from pyspec import COMPACT_RTOL
+    errors = []
+    for band in bands:
+        full = collec.get_heatmap_array(*band)
+        error = np.abs(compact.get_heatmap_array(*band) - full).max()
+        errors.append(float(error / (np.abs(full).max() or 1.0)))
+    return {"tolerance": COMPACT_RTOL, "heatmap_errors": errors,
+            "within_tolerance": max(errors) <= COMPACT_RTOL,
+            "nbytes": collec.nbytes(), "compact_nbytes": compact.nbytes()}
+
+
+def check_despike(collec, num_spikes=None, processes=None, seed=0):
+    """Despikes the clean synthetic map of collec, where every replacement
+    is a false positive, then the same map with num_spikes cosmic-ray spikes
+    (one per 20 pixels by default) added at random, and counts the spikes
+    found and the clean points replaced"""
+    from preprocessing import despike
+    rng = np.random.RandomState(seed)
+    clean = np.asarray(collec.cube)
+    _, clean_counts = despike(collec, processes=processes)
+    pixels = np.argwhere(collec.mask)
+    num_spikes = num_spikes or max(1, len(pixels) // 20)
+    hit = pixels[rng.randint(0, len(pixels), num_spikes)]
+    points = rng.randint(0, clean.shape[2], num_spikes)
+    cube = clean.copy()
+    cube[hit[:, 0], hit[:, 1], points] += rng.uniform(50, 500, num_spikes)
+    spiked = np.zeros(cube.shape, dtype=bool)
+    spiked[hit[:, 0], hit[:, 1], points] = True
+    despiked, _ = despike(collec.with_cube(cube), processes=processes)
+    replaced = np.asarray(despiked.cube) != cube
+    return {"clean_replaced": int(clean_counts.sum()), "spikes": int(spiked.sum()),
+            "found": int((replaced & spiked).sum()),
+            "false_positives": int((replaced & ~spiked).sum())}
+
+
+def run_benchmarks(data_dir, repeat=3, slices=50, processes=None, verbose=True):
+    """Times every stage on the synthetic data in data_dir. Returns a dict of
+    name -> {"times": [...], "best": ..., "median": ...}, the check_compact
+    report and the check_despike report"""
+    from pyspec import SpectrumData, SpectrumCollection, from_area_dir, from_line_file
+    from preprocessing import rubberband_correct, despike
+
+    area_dir = os.path.join(data_dir, "area")
+    line_file = os.path.join(data_dir, "line.txt")
+    files = [os.path.join(area_dir, f) for f in sorted(os.listdir(area_dir)) if f.endswith(".txt")]
+
+    results = {}
+
+    def bench(name, func, times=repeat):
+        elapsed, result = measure(func, times)
+        results[name] = {"times": elapsed, "best": min(elapsed),
+                         "median": float(np.median(elapsed))}
+        if verbose:
+            print("{:<28} best {:9.4f} s   median {:9.4f} s".format(
+                name, results[name]["best"], results[name]["median"]))
+        return result
+
+    spectra = bench("SpectrumData.from_file", lambda: [SpectrumData.from_file(f) for f in files])
+    bench("from_area_dir", lambda: from_area_dir(area_dir, processes=processes, dense=False))
+    bench("from_line_file", lambda: from_line_file(line_file))
+    collec = bench("from_spectrum_data_list",
+                   lambda: SpectrumCollection.from_spectrum_data_list(spectra))
+    bench("build_cube", lambda: SpectrumCollection.from_spectrum_data_list(spectra).build_cube(), 1)
+
+    wavenums = np.sort(collec.get_wavenums())
+    picks = wavenums[np.linspace(0, len(wavenums) - 1, min(slices, len(wavenums))).astype(int)]
+    band = (1300.0, 1700.0)
+
+    # The per-spectrum paths, before the cube exists
+    bench("get_img_array", lambda: [collec.get_img_array(w, False) for w in picks])
+    bench("get_heatmap_array", lambda: collec.get_heatmap_array(*band))
+
+    collec.build_cube()
+    bench("get_img_array (cube)", lambda: [collec.get_img_array(w, False) for w in picks])
+    bench("get_heatmap_array (cube)", lambda: collec.get_heatmap_array(*band))
+
+    out_dir = tempfile.mkdtemp(prefix="pyspectrum_export_")
+    cwd = os.getcwd()
+    try:
+        # map_images writes into the working directory
+        os.chdir(out_dir)
+        bench("map_images", lambda: collec.map_images(picks))
+        bench("map_images (multipage)", lambda: collec.map_images(picks, multipage="stack.tiff"))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(out_dir)
+
+    bench("rubberband_correct", lambda: rubberband_correct(collec, processes), 1)
+    bench("despike", lambda: despike(collec, processes=processes), 1)
+    spikes = check_despike(collec, processes=processes)
+    if verbose:
+        print("despike: {} points replaced in the clean map, {} of {} spikes found, "
+              "{} false positives".format(spikes["clean_replaced"], spikes["found"],
+                                          spikes["spikes"], spikes["false_positives"]))
+
+    compact = bench("from_area_dir (compact)",
+                    lambda: from_area_dir(area_dir, processes=processes, compact=True))
+    bench("get_img_array (compact)", lambda: [compact.get_img_array(w, False) for w in picks])
+    bench("get_heatmap_array (compact)", lambda: compact.get_heatmap_array(*band))
+    report = check_compact(collec, compact, [band, (wavenums[0], wavenums[-1])])
+    if verbose:
+        print("compact: {:.1f} MiB instead of {:.1f} MiB, heatmaps within {:.2g} "
+              "of float64 (tolerance {:g})".format(
+                  report["compact_nbytes"]["total"] / 1048576.0,
+                  report["nbytes"]["total"] / 1048576.0,
+                  max(report["heatmap_errors"]), report["tolerance"]))
+    return results, report, spikes
+
+
+def environment():
+    """Describes the machine and library versions the benchmarks ran with"""
+    import scipy
+    return {"python": platform.python_version(), "numpy": np.__version__,
+            "scipy": scipy.__version__, "matplotlib": matplotlib.__version__,
+            "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": cpu_count()}
+
+
+def compare(results, baseline):
+    """Prints the best time of every benchmark against a previous run"""
+    print("\n{:<28} {:>10} {:>10} {:>8}".format("benchmark", "before", "after", "speedup"))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]["best"]
+        after = result["best"]
+        print("{:<28} {:10.4f} {:10.4f} {:7.2f}x".format(name, before, after,
+                                                      before / after if after else float("inf")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--size", choices=sorted(SIZES), default="small",
+                        help="preset dataset size (default small)")
+    parser.add_argument("--xs", type=int, help="number of X points, overrides --size")
+    parser.add_argument("--ys", type=int, help="number of Y points, overrides --size")
+    parser.add_argument("--wavenums", type=int, help="points per spectrum, overrides --size")
+    parser.add_argument("--line-points", type=int,
+                        help="spectra in the linescan file (default xs * ys)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark")
+    parser.add_argument("--slices", type=int, default=50,
+                        help="wavenumber slices for the image and export benchmarks")
+    parser.add_argument("--processes", type=int, help="worker processes (default all cores)")
+    parser.add_argument("--data-dir",
+                        help="keep the synthetic data here and reuse it on later runs")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON results file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    num_xs, num_ys, num_wavenums = SIZES[args.size]
+    sizes = {"num_xs": args.xs or num_xs, "num_ys": args.ys or num_ys,
+             "num_wavenums": args.wavenums or num_wavenums}
+    sizes["line_points"] = args.line_points or sizes["num_xs"] * sizes["num_ys"]
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="pyspectrum_bench_")
+    try:
+        sizes_file = os.path.join(data_dir, "sizes.json")
+        if os.path.exists(sizes_file):
+            with open(sizes_file) as saved:
+                generated = json.load(saved) == sizes
+        else:
+            generated = False
+        if not generated:
+            print("Generating synthetic data in {}".format(data_dir))
+            if os.path.exists(os.path.join(data_dir, "area")):
+                shutil.rmtree(os.path.join(data_dir, "area"))
+            make_area_scan(os.path.join(data_dir, "area"), sizes["num_xs"], sizes["num_ys"],
+                           sizes["num_wavenums"])
+            make_linescan(os.path.join(data_dir, "line.txt"), sizes["line_points"],
+                          sizes["num_wavenums"])
+            with open(sizes_file, "w") as saved:
+                json.dump(sizes, saved)
+        results, compact, spikes = run_benchmarks(data_dir, args.repeat, args.slices, args.processes)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "sizes": sizes,
+              "repeat": args.repeat, "slices": args.slices,
+              "environment": environment(), "results": results, "compact": compact,
+              "despike": spikes}
+    with open(args.output, "w") as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    print("Results written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous)["results"])
+
+    # Compact mode promises heatmaps within COMPACT_RTOL, a benchmark run
+    # that breaks the promise fails
+    if not compact["within_tolerance"]:
+        sys.exit("compact heatmaps differ from float64 by {:.2g}, more than the "
+                 "tolerance of {:g}".format(max(compact["heatmap_errors"]), compact["tolerance"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
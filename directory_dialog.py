@@ -68,8 +68,12 @@ class DialogGUIBox(QtGui.QWidget):
         # if linescan is checked, change linescan bool to true
         if self.check_line.isChecked():
             linescan = True
-        self.close()
-        self.build_plot_display(self.selected_directory, linescan)
+        self.hide()
+        # Loading runs in the background, come back if it fails or is cancelled
+        self.task = self.build_plot_display(self.selected_directory, linescan)
+        self.task.succeeded.connect(self.close)
+        self.task.failed.connect(self.show)
+        self.task.cancelled.connect(self.show)
 
 if __name__ == "__main__":
     app = QtGui.QApplication(sys.argv)
@@ -0,0 +1,112 @@
+"""
+Direct export of wavenumber slices as TIFF images.
+
+Slices are taken from SpectrumCollection.iter_img_arrays, scaled to 8 bits,
+colored through a colormap lookup table and written with PIL, either as one
+file per wavenumber or as a single multipage TIFF. No matplotlib figures are
+created, so the export runs headless with flat memory use.
+"""
+import os
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from parallel import map_blocks, with_progress
+from profiling import profiled
+
+
+def colormap_lut(cmap="gray"):
+    """Returns a (256, 3) uint8 lookup table for a matplotlib colormap name,
+    or None for plain greyscale"""
+    if cmap == "gray":
+        return None
+    import matplotlib
+    try:
+        colormap = matplotlib.colormaps[cmap]
+    except AttributeError:
+        # matplotlib < 3.5
+        from matplotlib import cm
+        colormap = cm.get_cmap(cmap)
+    return (colormap(np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
+
+
+def colorize(img_array, lut=None, vmin=None, vmax=None):
+    """Scales img_array linearly from vmin..vmax (its own min..max by default,
+    as imshow does) to 0..255 and maps it through lut. Returns a uint8 array,
+    (rows, cols) for greyscale or (rows, cols, 3) with a lut"""
+    vmin = np.nanmin(img_array) if vmin is None else vmin
+    vmax = np.nanmax(img_array) if vmax is None else vmax
+    span = vmax - vmin if vmax > vmin else 1.0
+    levels = np.nan_to_num((img_array - vmin) * (255.0 / span))
+    levels = np.clip(levels, 0, 255).astype(np.uint8)
+    return levels if lut is None else lut[levels]
+
+
+def stretch(img, scale=1, aspect=None):
+    """Nearest neighbour upscaling by scale, then repeating rows until
+    height / width is at least aspect (so linescans stay visible)"""
+    if scale > 1:
+        img = np.repeat(np.repeat(img, scale, axis=0), scale, axis=1)
+    if aspect is not None and img.shape[0] < aspect * img.shape[1]:
+        rows = int(np.ceil(aspect * img.shape[1] / img.shape[0]))
+        img = np.repeat(img, rows, axis=0)
+    return img
+
+
+def render_slice(img_array, lut=None, scale=1, aspect=None):
+    """Turns a get_img_array result into the uint8 image written to disk,
+    oriented as the former matplotlib export displayed it"""
+    return stretch(colorize(np.flipud(img_array), lut), scale, aspect)
+
+
+def _write_slice(args):
+    """Thread worker: renders one slice and writes it to filename"""
+    from PIL import Image
+    filename, img_array, lut, scale, aspect = args
+    Image.fromarray(render_slice(img_array, lut, scale, aspect)).save(filename, "TIFF")
+    return filename
+
+
+def _render_slice(args):
+    """Thread worker: renders one slice for a multipage file"""
+    img_array, lut, scale, aspect = args
+    return render_slice(img_array, lut, scale, aspect)
+
+
+@profiled()
+def export_stack(collec, out_dir=".", wavenums=None, linescan=False, cmap="gray",
+                 multipage=None, threads=None, scale=1, aspect=None, progress=None):
+    """
+    Writes the image of every wavenum in wavenums (all of them by default)
+    to out_dir as <wavenum>.tiff, the names ImageStack expects. If multipage
+    is a file name, the slices are written as the pages of that one TIFF
+    instead. Slices are rendered in threads worker threads (one per core by
+    default) and progress(done, total) is called as they are written.
+    Returns the list of files written.
+    """
+    from PIL import Image, TiffImagePlugin
+    if wavenums is None:
+        wavenums = collec.get_wavenums()
+    lut = colormap_lut(cmap)
+    slices = collec.iter_img_arrays(wavenums, linescan)
+    if multipage is None:
+        tasks = ((os.path.join(out_dir, str(wavenum) + ".tiff"), img_array, lut, scale, aspect)
+                 for wavenum, img_array in slices)
+        written = map_blocks(_write_slice, tasks, threads, ThreadPool)
+        return list(with_progress(written, len(wavenums), progress))
+    filename = os.path.join(out_dir, multipage)
+    tasks = ((img_array, lut, scale, aspect) for wavenum, img_array in slices)
+    with TiffImagePlugin.AppendingTiffWriter(filename, True) as tiff:
+        rendered = map_blocks(_render_slice, tasks, threads, ThreadPool)
+        for img in with_progress(rendered, len(wavenums), progress):
+            Image.fromarray(img).save(tiff)
+            tiff.newFrame()
+    return [filename]
+
+
+def save_heatmap(heatmap_array, filename, cmap="hot", scale=1, aspect=None):
+    """Writes a get_heatmap_array result as an image (format from the file
+    extension), oriented and clipped at zero as gen_heatmap shows it"""
+    from PIL import Image
+    img = stretch(colorize(np.flipud(np.clip(heatmap_array, 0, None)), colormap_lut(cmap)),
+                  scale, aspect)
+    Image.fromarray(img).save(filename)
+    return filename
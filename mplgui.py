@@ -1,16 +1,23 @@
-import sys, os
+import sys
 from PySide import QtGui, QtCore
 import numpy as np
-from scipy.spatial import ConvexHull
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt4agg import NavigationToolbar2QT as NavigationToolbar
 import matplotlib.pyplot as plt
 from tiff_stack import ImageStack
+from preprocessing import rubberband
+from workers import run_task
+from profiling import stage
+from pyramid import extent, level_for_view, level_shape, num_levels, region_heatmap, visible_pixels
+from roi import heatmap_polygon, heatmap_rectangle, pixel_rectangle_stats, polygon_stats
+
+#: Milliseconds the heatmap waits after a zoom or pan before refining
+REFINE_DELAY = 200
 
 class PlotDisplay(QtGui.QDialog):
     """Creates the main application window"""
 
-    def __init__(self, spectrum_collec, gen_heatmap, map, path, parent=None):
+    def __init__(self, spectrum_collec, gen_heatmap, map, path, linescan=False, parent=None):
 
         super(PlotDisplay, self).__init__(parent)
 
@@ -30,8 +37,9 @@ class PlotDisplay(QtGui.QDialog):
 
         # initializations for image stack creation
         self.path = path
-        self.stack = ImageStack(self.my_collec, self.path)
-        self.stack.setWindowTitle('TIFF Image Stack')
+        self.linescan = linescan
+        self.stack = ImageStack(self.my_collec, linescan)
+        self.stack.setWindowTitle('Image Stack')
 
         self.ax = self.figure.add_subplot(111)
 
@@ -39,6 +47,24 @@ class PlotDisplay(QtGui.QDialog):
         # it takes the `figure` instance as a parameter to __init__
         self.canvas = FigureCanvas(self.figure)
 
+        # artists reused between plots, and the background cached after each
+        # full redraw so slider moves only blit the vertical lines
+        self.spec_line = None
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+        # heatmap image drawn from the pyramid, its (level, rows, cols) and
+        # band, and a counter telling stale refinements from current ones
+        self.hm_image = None
+        self.hm_view = None
+        self.hm_band = None
+        self.hm_generation = 0
+        self.hm_callbacks = []
+        self.refine_pending = False
+
+        # rectangle or polygon selector drawing a region on the heatmap
+        self.selector = None
+
         # this is the Navigation widget
         # it takes the Canvas widget and a parent
         self.toolbar = NavigationToolbar(self.canvas, self)
@@ -138,10 +164,24 @@ class PlotDisplay(QtGui.QDialog):
         self.hm_button = QtGui.QPushButton('Generate Heatmap')
         self.hm_button.clicked.connect(self.hm_make)
 
+        # add buttons for drawing a region on the heatmap and plotting the
+        # mean spectrum of the pixels inside
+        self.rect_button = QtGui.QPushButton('Rectangle Region Mean')
+        self.rect_button.clicked.connect(self.select_rectangle)
+        self.poly_button = QtGui.QPushButton('Polygon Region Mean')
+        self.poly_button.clicked.connect(self.select_polygon)
+        region_layout = QtGui.QHBoxLayout()
+        region_layout.addWidget(self.rect_button)
+        region_layout.addWidget(self.poly_button)
+
         # add button for image stack pop out window
         self.map_img = QtGui.QPushButton('View Image Stack')
         self.map_img.clicked.connect(self.img_stack)
 
+        # add button for writing the image stack as TIFF files
+        self.export_img = QtGui.QPushButton('Export Image Stack')
+        self.export_img.clicked.connect(self.export_stack)
+
         # add baseline correction button
         self.bg_test = QtGui.QPushButton('Baseline Correction')
         self.bg_test.clicked.connect(self.rb_test)
@@ -154,36 +194,85 @@ class PlotDisplay(QtGui.QDialog):
         layout.addWidget(splitter)
         layout.addWidget(slider_group)
         layout.addWidget(self.hm_button)
+        layout.addLayout(region_layout)
         layout.addWidget(self.map_img)
+        layout.addWidget(self.export_img)
         layout.addWidget(self.bg_test)
         self.setLayout(layout)
 
     def plot(self):
         """"Create matplotlib plot for specific X and Y contained in my_collec"""
 
-        # discards the old graph
-        self.ax.hold(False)
+        with stage("gui.plot"):
+            # get data from combo box
+            curr_spec = self.selected_spectrum()
 
-        # get data from combo box
+            # plot data
+            self.show_spectrum(curr_spec.info[1], curr_spec.info[0])
+
+    def selected_spectrum(self):
+        """Returns the SpectrumData object selected in the X and Y combo boxes"""
         curr_x = self.drop_down_x.itemText(self.drop_down_x.currentIndex())
         curr_y = self.drop_down_y.itemText(self.drop_down_y.currentIndex())
+        return self.my_collec.get_spectrum(float(curr_x), float(curr_y))
 
-        # plot data
-        spectra_list = self.my_collec.spectra
-        for i, spectrum in enumerate(spectra_list):
-            if (spectrum.x == float(curr_x)) and (spectrum.y == float(curr_y)):
-                self.ax.scatter(*zip(*self.my_collec.spectra[i].info_flipped))
-                self.ax.grid('on')
+    def show_spectrum(self, wavenums, intens):
+        """Shows a spectrum with the two vertical lines, updating the existing
+        artists instead of creating new ones"""
+
+        # discards the old graph if something else (a heatmap) was drawn
+        if self.ax.images or self.ax.collections:
+            self.clear_axes()
 
-        # add left vert line
-        self.vert_line = self.ax.axvline(x = 0)
+        if self.spec_line is None:
+            self.spec_line, = self.ax.plot(wavenums, intens, 'o', markersize=4.5)
+            self.ax.grid('on')
 
-        # add right vert line
-        self.vert_line_2 = self.ax.axvline(x = 0)
+            # add left and right vert lines, animated so that they are only
+            # drawn by blitting
+            self.vert_line = self.ax.axvline(x = self.wavenums[self.sld.sliderPosition()],
+                                             animated=True)
+            self.vert_line_2 = self.ax.axvline(x = self.wavenums[self.sld_2.sliderPosition()],
+                                               animated=True)
+        else:
+            self.spec_line.set_data(wavenums, intens)
+
+        self.ax.relim()
+        self.ax.autoscale_view()
 
         # refresh canvas
         self.canvas.draw()
 
+    def clear_axes(self):
+        """Clears the axes and forgets the artists drawn on them. Until the
+        next spectrum there are no lines, so nothing is blitted."""
+        self.end_selection()
+        self.ax.cla()
+        self.spec_line = None
+        self.vert_line = None
+        self.vert_line_2 = None
+        self.background = None
+        self.hm_image = None
+
+    def on_draw(self, event):
+        """After a full redraw, cache the background and draw the lines on it"""
+        # a heatmap has no lines to blit over it
+        if self.vert_line is None:
+            return
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.vert_line)
+        self.ax.draw_artist(self.vert_line_2)
+
+    def blit_lines(self):
+        """Redraw only the vertical lines over the cached background"""
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.vert_line)
+        self.ax.draw_artist(self.vert_line_2)
+        self.canvas.blit(self.ax.bbox)
+
     def selection_change(self):
         """If the X drop down value changes, get the matching Y's corresponding to the new X"""
 
@@ -196,20 +285,12 @@ class PlotDisplay(QtGui.QDialog):
 
     def get_wavenums(self):
         """"Makes a list of all wavenums in spectra"""
-        wavenums = []
-        for spectrum in self.my_collec.spectra:
-            wavenums = spectrum.info[1]
-
-        wavenums.sort()
-        return wavenums
+        return np.sort(self.my_collec.get_wavenums())
 
     def sld_change(self):
         """If left and/or right slider changes, set respective text to correct wavenumber, move line
         vertical line to correct position"""
 
-        self.vert_line.remove()
-        self.vert_line_2.remove()
-
         curr_pos = self.sld.sliderPosition()
         curr_wavenum = self.wavenums[curr_pos]
 
@@ -219,10 +300,15 @@ class PlotDisplay(QtGui.QDialog):
         self.textedit.setText(str(curr_wavenum))
         self.textedit_2.setText(str(curr_wavenum_2))
 
-        self.vert_line = self.ax.axvline(x = curr_wavenum)
-        self.vert_line_2 = self.ax.axvline(x = curr_wavenum_2)
+        # nothing plotted yet, or a heatmap
+        if self.vert_line is None:
+            return
 
-        self.canvas.draw()
+        with stage("gui.sld_change"):
+            self.vert_line.set_xdata([curr_wavenum, curr_wavenum])
+            self.vert_line_2.set_xdata([curr_wavenum_2, curr_wavenum_2])
+
+            self.blit_lines()
 
     def hm_make(self):
         """
@@ -234,18 +320,188 @@ class PlotDisplay(QtGui.QDialog):
         curr_pos_2 = self.sld_2.sliderPosition()
         curr_wavenum_2 = self.wavenums[curr_pos_2]
 
-        self.ax.grid('off')
-        self.gen_heatmap(curr_wavenum, curr_wavenum_2)
-
+        if self.linescan or self.my_collec.cube is None:
+            # integrate in the background, then draw on the GUI thread
+            def draw(heatmap_array):
+                with stage("gui.hm_make (draw)"):
+                    # linescan heatmaps get a figure of their own
+                    if not self.linescan:
+                        self.clear_axes()
+                    self.gen_heatmap(curr_wavenum, curr_wavenum_2, heatmap_array)
+                    self.canvas.draw()
+            self.task = run_task(self, "Generating heatmap...", draw,
+                                 self.my_collec.get_heatmap_array, curr_wavenum, curr_wavenum_2)
+            return
+
+        # large maps start from the coarsest pyramid level filling the axes,
+        # zooming in brings in the finer ones (see refine_heatmap)
+        collec = self.my_collec
+        level = level_for_view(collec.num_xs, collec.num_ys, self.ax.bbox.width,
+                               self.ax.bbox.height, num_levels(collec.num_xs, collec.num_ys))
+        num_xs, num_ys = level_shape(collec.num_xs, collec.num_ys, level)
+        view = (level, (0, num_xs), (0, num_ys))
+        self.hm_generation += 1
+        generation = self.hm_generation
+
+        def draw(heatmap_array):
+            if generation != self.hm_generation:
+                return
+            with stage("gui.hm_make (draw)"):
+                self.clear_axes()
+                self.gen_heatmap(curr_wavenum, curr_wavenum_2, heatmap_array,
+                                 extent(collec, *view))
+                self.hm_image = self.ax.images[-1]
+                self.hm_view = view
+                self.hm_band = (curr_wavenum, curr_wavenum_2)
+                # cla() drops axes callbacks, so connect after every heatmap
+                for cid in self.hm_callbacks:
+                    self.ax.callbacks.disconnect(cid)
+                self.hm_callbacks = [
+                    self.ax.callbacks.connect('xlim_changed', self.schedule_refine),
+                    self.ax.callbacks.connect('ylim_changed', self.schedule_refine)]
+                self.canvas.draw()
+        self.task = run_task(self, "Generating heatmap...", draw, self.level_heatmap,
+                             curr_wavenum, curr_wavenum_2, *view)
+
+    def level_heatmap(self, wnum_1, wnum_2, level, rows, cols, progress=None):
+        """Heatmap of pixels rows by cols of a pyramid level, building the
+        level first if needed"""
+        source = self.my_collec.pyramid(level, progress)
+        if rows == (0, source.num_xs) and cols == (0, source.num_ys):
+            return source.get_heatmap_array(wnum_1, wnum_2, progress)
+        return region_heatmap(source, wnum_1, wnum_2, rows, cols)
+
+    def schedule_refine(self, ax):
+        """Axes limit callback: refines the heatmap once the view settles"""
+        if not self.refine_pending:
+            self.refine_pending = True
+            QtCore.QTimer.singleShot(REFINE_DELAY, self.refine_heatmap)
+
+    def refine_heatmap(self):
+        """
+        Redraws the heatmap from the pyramid level matching the zoomed or
+        panned view, when the level and pixels drawn do not already cover it
+        """
+        self.refine_pending = False
+        if self.hm_image is None or self.hm_image not in self.ax.images:
+            return
+        collec = self.my_collec
+        x_range, y_range = self.ax.get_xlim(), self.ax.get_ylim()
+        level = level_for_view(abs(x_range[1] - x_range[0]), abs(y_range[1] - y_range[0]),
+                               self.ax.bbox.width, self.ax.bbox.height,
+                               num_levels(collec.num_xs, collec.num_ys))
+        rows, cols = visible_pixels(collec, level, x_range, y_range)
+        if rows[0] == rows[1] or cols[0] == cols[1]:
+            # panned off the map
+            return
+        drawn_level, drawn_rows, drawn_cols = self.hm_view
+        if (level == drawn_level and drawn_rows[0] <= rows[0] and rows[1] <= drawn_rows[1] and
+                drawn_cols[0] <= cols[0] and cols[1] <= drawn_cols[1]):
+            return
+
+        # integrate half a view more on every side, so short pans are covered
+        num_xs, num_ys = level_shape(collec.num_xs, collec.num_ys, level)
+        margin = (rows[1] - rows[0]) // 2
+        rows = (max(rows[0] - margin, 0), min(rows[1] + margin, num_xs))
+        margin = (cols[1] - cols[0]) // 2
+        cols = (max(cols[0] - margin, 0), min(cols[1] + margin, num_ys))
+        view = (level, rows, cols)
+        image = self.hm_image
+        generation = self.hm_generation
+
+        def draw(heatmap_array):
+            if generation != self.hm_generation or image is not self.hm_image:
+                return
+            with stage("gui.refine_heatmap (draw)"):
+                heatmap_array[heatmap_array < 0] = 0
+                # set_extent autoscales, keep the limits the user chose
+                xlim, ylim = self.ax.get_xlim(), self.ax.get_ylim()
+                image.set_data(heatmap_array)
+                image.set_extent(extent(collec, *view))
+                self.ax.set_xlim(xlim)
+                self.ax.set_ylim(ylim)
+                self.hm_view = view
+                self.canvas.draw_idle()
+        self.task = run_task(self, "Refining heatmap...", draw, self.level_heatmap,
+                             self.hm_band[0], self.hm_band[1], *view)
+
+    def select_rectangle(self):
+        """Lets the user drag a rectangle on the heatmap"""
+        self.select_region(polygon=False)
+
+    def select_polygon(self):
+        """Lets the user click the vertices of a polygon on the heatmap"""
+        self.select_region(polygon=True)
+
+    def select_region(self, polygon):
+        """Starts drawing a region on the heatmap, its mean spectrum is shown
+        once the region is complete"""
+        if self.hm_image is None or self.hm_image not in self.ax.images:
+            QtGui.QMessageBox.information(self, "Region Mean",
+                                          "Generate a heatmap first, then draw the region on it.")
+            return
+        from matplotlib.widgets import PolygonSelector, RectangleSelector
+        self.end_selection()
+        if polygon:
+            self.selector = PolygonSelector(self.ax, self.polygon_selected, useblit=True)
+        else:
+            self.selector = RectangleSelector(self.ax, self.rectangle_selected, useblit=True)
+
+    def end_selection(self):
+        """Stops the region selector, if one is active"""
+        if self.selector is not None:
+            self.selector.set_active(False)
+            self.selector.disconnect_events()
+            self.selector = None
+
+    def rectangle_selected(self, press, release):
+        """Rectangle selector callback, averages the pixels inside from the
+        summed-area tables"""
+        rows, cols = heatmap_rectangle(self.my_collec, (press.xdata, release.xdata),
+                                       (press.ydata, release.ydata))
+        self.show_region(pixel_rectangle_stats, rows, cols)
+
+    def polygon_selected(self, vertices):
+        """Polygon selector callback, averages the pixels inside"""
+        self.show_region(polygon_stats, heatmap_polygon(self.my_collec, vertices), True)
+
+    def show_region(self, func, *args):
+        """Computes func(my_collec, *args) in the background, a roi RegionStats,
+        and plots its mean spectrum within one standard deviation"""
+        self.end_selection()
+
+        def draw(stats):
+            if not stats.count:
+                QtGui.QMessageBox.information(self, "Region Mean", "No spectra in the region.")
+                return
+            with stage("gui.show_region (draw)"):
+                self.show_spectrum(stats.wavenums, stats.mean)
+                self.ax.fill_between(stats.wavenums, stats.mean - stats.std,
+                                     stats.mean + stats.std, alpha=0.3)
+                self.ax.set_title("Mean of {} spectra".format(stats.count))
+                self.canvas.draw()
+        self.task = run_task(self, "Averaging region...", draw, func, self.my_collec, *args)
 
     def img_stack(self):
         """
-        Show scrollable set of TIFF images
+        Show scrollable set of images, rendered from the collection on demand
+        """
+        if not self.stack.level:
+            self.stack.show()
+            return
+
+        # bin the map for the stack in the background the first time
+        def show(source):
+            self.stack.show_images()
+            self.stack.show()
+        self.task = run_task(self, "Binning the map...", show, self.my_collec.pyramid,
+                             self.stack.level)
+
+    def export_stack(self):
         """
-        file_names = [f for f in sorted(os.listdir(self.path)) if f.endswith(".tiff")]
-        if len(file_names) == 0:
-            self.map()
-        self.stack.show()
+        Write the image stack as TIFF files into the scan directory
+        """
+        self.task = run_task(self, "Exporting image stack...", None, self.map)
 
     def bg_sub_test(self):
         """
@@ -298,59 +554,20 @@ class PlotDisplay(QtGui.QDialog):
         """
         Background/baseline subtraction using 'rubberband correction' method
         """
-        # get data from combo box
-        curr_x = self.drop_down_x.itemText(self.drop_down_x.currentIndex())
-        curr_y = self.drop_down_y.itemText(self.drop_down_y.currentIndex())
-
-        # get vertex points
-        curr_spec = None
-        curr_spec_plt = None
-        spectra_list = self.my_collec.spectra
-        for i, spectrum in enumerate(spectra_list):
-            if (spectrum.x == float(curr_x)) and (spectrum.y == float(curr_y)):
-                curr_spec = self.my_collec.spectra[i]
-
-        # Separate x and y values into two separate lists
-        x = curr_spec.info[1]
-        y = curr_spec.info[0]
+        with stage("gui.rb_test"):
+            # get data from combo box
+            curr_spec = self.selected_spectrum()
 
-        # Zip to create np array of (x, y) tuples
-        zipped = np.column_stack((x, y))
+            # Separate x and y values into two separate lists
+            x = curr_spec.info[1]
+            y = curr_spec.info[0]
 
-        # Find the convex hull, where array v contains the indices of the convex hull
-        # vertex points arranged in a counter clockwise direction
-        v = ConvexHull(zipped).vertices
+            # Find new y values using baseline
+            new_y = y - rubberband(x, y)
 
-        # Rotate convex hull vertices until v starts from the lowest one
-        v = np.roll(v, -v.argmin())
-
-        # Leave only the ascending part
-        v = v[:v.argmax()]
-
-        # Create baseline using linear interpolation between vertices
-        bsln = np.interp(x, x[v], y[v])
-
-        # Find new y values using baseline
-        new_y = []
-        for i, point in enumerate(y):
-            point -= bsln[i]
-            new_y.append(point)
-
-        # convert list of x and new y's into an np array of tuples
-        x_y = np.column_stack((x, new_y))
-
-        # plot the new spectrum
-        self.ax.scatter(*zip(*x_y))
-
-        self.ax.grid(which='both')
-
-        # add left vert line
-        self.vert_line = self.ax.axvline(x = 0)
-
-        # add right vert line
-        self.vert_line_2 = self.ax.axvline(x = 0)
-
-        self.canvas.draw()
+            # plot the new spectrum in place of the old one
+            self.show_spectrum(x, new_y)
+            self.ax.grid(which='both')
 
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
@@ -0,0 +1,50 @@
+"""
+Helpers for spreading work over worker pools and reporting progress.
+
+Long operations take an optional progress callback, called as
+progress(done, total). A callback may raise to cancel the operation; pools
+are terminated on the way out.
+"""
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+
+def map_blocks(func, tasks, processes=None, pool_type=Pool):
+    """Applies func to every task, in a pool of processes worker processes
+    (all cores by default, none for processes=1), yielding results in order.
+    Only a few tasks are in flight at a time, so a lazily generated task
+    list is never held in memory all at once. Pass ThreadPool as pool_type
+    for work that releases the GIL."""
+    if processes == 1:
+        for task in tasks:
+            yield func(task)
+        return
+    processes = processes or cpu_count()
+    pool = pool_type(processes)
+    completed = False
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        completed = True
+    finally:
+        # Abandoned or failed runs must not wait for the queued tasks
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+
+def with_progress(items, total, progress=None):
+    """Yields items, calling progress(done, total) about every percent of
+    the way when a progress callback is given"""
+    step = max(1, total // 100)
+    for done, item in enumerate(items, 1):
+        yield item
+        if progress is not None and (done % step == 0 or done == total):
+            progress(done, total)
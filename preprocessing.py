@@ -0,0 +1,391 @@
+"""
+Whole-map preprocessing stages.
+
+Each stage works on the cube of a SpectrumCollection (see build_cube) and
+returns a new collection over the processed cube, so heatmaps and image
+stacks can be computed from the processed data with the usual methods.
+"""
+import numpy as np
+from parallel import map_blocks, with_progress
+from profiling import profiled
+
+#: Upper bound on the bytes of cube data handed to one worker task
+TASK_BYTES = 16 * 1024 * 1024
+
+#: Wavenumber axes closer than this (in 1/cm) everywhere count as the same axis
+AXIS_ATOL = 1e-6
+
+#: Spectra compared or resampled per vectorized step
+AXIS_BLOCK = 4096
+
+
+def shared_axis(spectra, atol=AXIS_ATOL):
+    """Returns the wavenumber axis of the last spectrum if every spectrum
+    has the same axis (within atol), otherwise None"""
+    reference = spectra[-1].info[1]
+    for start in range(0, len(spectra), AXIS_BLOCK):
+        block = spectra[start:start + AXIS_BLOCK]
+        if any(spectrum.info.shape[1] != len(reference) for spectrum in block):
+            return None
+        axes = np.array([spectrum.info[1] for spectrum in block])
+        if len(reference) and np.abs(axes - reference).max() > atol:
+            return None
+    return reference
+
+
+def common_axis(spectra):
+    """Evenly spaced wavenumber axis over the range covered by every
+    spectrum, with as many points as the typical spectrum. Raises ValueError
+    if the spectra have no range in common."""
+    return range_axis([spectrum.info[1].min() for spectrum in spectra],
+                      [spectrum.info[1].max() for spectrum in spectra],
+                      [spectrum.info.shape[1] for spectrum in spectra])
+
+
+def range_axis(lows, highs, lengths):
+    """common_axis of spectra with the given lowest and highest wavenumbers
+    and numbers of points, for loaders that do not keep the spectra"""
+    low, high = np.max(lows), np.min(highs)
+    if not low < high:
+        raise ValueError("Spectra have no wavenumber range in common")
+    return np.linspace(low, high, max(int(np.median(lengths)), 2))
+
+
+def resample(axes, intens, grid):
+    """
+    Linear interpolation of many spectra onto grid at once, the same as
+    np.interp(grid, axes[k], intens[k]) for every k (values beyond the ends
+    of a spectrum are held constant). Returns a (len(axes), len(grid)) array.
+
+    All spectra are concatenated into one array and row k is shifted by
+    k times the total wavenumber span, so that a single searchsorted over
+    the whole array finds the neighbours of every grid point in every
+    spectrum.
+    """
+    axes = [np.asarray(axis, dtype=float) for axis in axes]
+    intens = [np.asarray(values, dtype=float) for values in intens]
+    for k, axis in enumerate(axes):
+        if len(axis) > 1 and (np.diff(axis) < 0).any():
+            order = np.argsort(axis, kind='mergesort')
+            axes[k], intens[k] = axis[order], intens[k][order]
+    lengths = np.array([len(axis) for axis in axes])
+    if (lengths == 0).any():
+        raise ValueError("Cannot resample an empty spectrum")
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ends = starts + lengths - 1
+    x = np.concatenate(axes)
+    y = np.concatenate(intens)
+    base = min(x.min(), grid.min())
+    span = max(x.max(), grid.max()) - base + 1.0
+    rows = np.arange(len(axes))
+    keys = (x - base) + np.repeat(rows, lengths) * span
+    targets = (grid - base)[np.newaxis, :] + rows[:, np.newaxis] * span
+    lo = np.searchsorted(keys, targets, side='right') - 1
+    lo = np.clip(lo, starts[:, np.newaxis], ends[:, np.newaxis])
+    hi = np.minimum(lo + 1, ends[:, np.newaxis])
+    dx = x[hi] - x[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(dx > 0, (grid - x[lo]) / dx, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return y[lo] + t * (y[hi] - y[lo])
+
+
+def resample_spectra(spectra, grid):
+    """Resamples a list of SpectrumData objects onto grid, in blocks of
+    AXIS_BLOCK spectra. Returns a (len(spectra), len(grid)) array."""
+    out = np.empty((len(spectra), len(grid)))
+    for start in range(0, len(spectra), AXIS_BLOCK):
+        block = spectra[start:start + AXIS_BLOCK]
+        out[start:start + len(block)] = resample([spectrum.info[1] for spectrum in block],
+                                                 [spectrum.info[0] for spectrum in block], grid)
+    return out
+
+
+def rubberband(wavenums, intens):
+    """
+    Baseline of one spectrum by the 'rubberband correction' method: linear
+    interpolation between the vertices of the lower convex hull.
+    wavenums must be sorted in increasing order. Spectra without a hull
+    (flat or collinear, e.g. dead or saturated pixels) get the straight line
+    between their end points.
+    """
+    from scipy.spatial import ConvexHull
+    try:
+        from scipy.spatial import QhullError
+    except ImportError:
+        # scipy < 1.8
+        from scipy.spatial.qhull import QhullError
+    # Find the convex hull, where array v contains the indices of the convex hull
+    # vertex points arranged in a counter clockwise direction
+    try:
+        v = ConvexHull(np.column_stack((wavenums, intens))).vertices
+    except QhullError:
+        return np.interp(wavenums, wavenums[[0, -1]], intens[[0, -1]])
+    # Rotate convex hull vertices until v starts from the lowest one
+    v = np.roll(v, -v.argmin())
+    # Leave only the ascending part
+    v = v[:v.argmax()]
+    # Create baseline using linear interpolation between vertices
+    return np.interp(wavenums, wavenums[v], intens[v])
+
+
+def _rubberband_block(args):
+    """Pool worker: baseline corrects the valid pixels of a block of X rows"""
+    wavenums, block, mask = args
+    baselines = np.zeros_like(block)
+    for i, j in zip(*np.nonzero(mask)):
+        baselines[i, j] = rubberband(wavenums, block[i, j])
+    return block - baselines
+
+
+def row_blocks(collec, task_bytes=TASK_BYTES):
+    """Splits the X rows of the cube into (start, stop) blocks of about
+    task_bytes each"""
+    row_bytes = max(1, collec.num_ys * collec.cube.shape[2] * collec.cube.itemsize)
+    rows = max(1, task_bytes // row_bytes)
+    return [(start, min(start + rows, collec.num_xs)) for start in range(0, collec.num_xs, rows)]
+
+
+def new_cube(collec, cube_file=None, shape=None, dtype=None):
+    """Allocates an output cube shaped like the cube of collec and of its
+    dtype (so compact float32 cubes stay compact), memory-mapped from
+    cube_file if given"""
+    shape = collec.cube.shape if shape is None else shape
+    dtype = collec.cube.dtype if dtype is None else dtype
+    if cube_file is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(cube_file, mode='w+', dtype=dtype, shape=shape)
+
+
+@profiled()
+def rubberband_correct(collec, processes=None, cube_file=None, progress=None):
+    """
+    Applies the rubberband baseline correction of PlotDisplay.rb_test to
+    every spectrum of collec. Blocks of X rows are corrected in parallel
+    worker processes and the subtraction is done per block. Returns a new
+    SpectrumCollection over the corrected cube (memory-mapped from
+    cube_file if given). progress(done, total) is called per block.
+    """
+    if collec.cube is None:
+        collec.build_cube()
+    wavenums = collec.wavenums
+    # The hull walk assumes increasing wavenums, linescans may be stored reversed
+    step = -1 if len(wavenums) > 1 and wavenums[0] > wavenums[-1] else 1
+    blocks = row_blocks(collec)
+    tasks = ((wavenums[::step], np.asarray(collec.cube[start:stop, :, ::step]),
+              collec.mask[start:stop]) for start, stop in blocks)
+    corrected = new_cube(collec, cube_file)
+    if len(blocks) < 2:
+        processes = 1
+    results = zip(blocks, map_blocks(_rubberband_block, tasks, processes))
+    for (start, stop), block in with_progress(results, len(blocks), progress):
+        corrected[start:stop] = block[:, :, ::step]
+    return collec.with_cube(corrected)
+
+
+#: Narrow features further than this many robust standard deviations above
+#: the same wavenumber in the neighbouring pixels, and above their own
+#: spectrum's noise, are taken as cosmic-ray spikes
+SPIKE_THRESHOLD = 6.0
+
+
+def _sort_pairs(values, pairs):
+    """Compare-exchange network: orders values[a] <= values[b] for every
+    (a, b) of pairs in turn, elementwise over whole arrays"""
+    for a, b in pairs:
+        values[a], values[b] = np.minimum(values[a], values[b]), np.maximum(values[a], values[b])
+    return values
+
+
+# Median selection networks for 9 and 5 values (the middle element ends up
+# being the median), far cheaper than sorting every neighbourhood
+_MEDIAN9 = [(1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8), (0, 3),
+            (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4), (4, 2)]
+_MEDIAN5 = [(0, 1), (3, 4), (0, 3), (1, 4), (1, 2), (2, 3), (1, 2)]
+
+
+def _neighbourhood(rows, cols):
+    """Padding and (i, j) offsets into the padded block of the 9 pixels
+    around and including every pixel of a rows by cols block: 3 x 3 on a
+    map, 9 in a row along a line (the centre is offset 4)"""
+    if min(rows, cols) > 1 or rows == cols == 1:
+        return ((1, 1), (1, 1)), [(i, j) for i in range(3) for j in range(3)]
+    if cols == 1:
+        return ((4, 4), (0, 0)), [(i, 0) for i in range(9)]
+    return ((0, 0), (4, 4)), [(0, j) for j in range(9)]
+
+
+def spatial_median(block, chunk=128):
+    """
+    Median of every wavenumber over the 9 neighbouring pixels (see
+    _neighbourhood), the median absolute deviation of the 9 from it, and the
+    largest value of the 8 around the centre. The block is mirrored outwards
+    at its edges, so an edge pixel is never its own neighbour. Runs over
+    chunk wavenumbers at a time, which keeps the network's temporaries in
+    cache.
+    """
+    rows, cols = block.shape[:2]
+    pad, offsets = _neighbourhood(rows, cols)
+    median = np.empty(block.shape)
+    deviation = np.empty(block.shape)
+    brightest = np.zeros(block.shape)
+    for start in range(0, block.shape[2], chunk):
+        padded = block[:, :, start:start + chunk]
+        for axis, (width, size) in enumerate(zip(pad, (rows, cols))):
+            if width[0]:
+                # Mirroring needs more pixels than it adds, else they repeat
+                axis_pad = [(0, 0)] * 3
+                axis_pad[axis] = width
+                padded = np.pad(padded, axis_pad,
+                                mode='reflect' if size > width[0] else 'edge')
+        shifted = [padded[i:i + rows, j:j + cols] for i, j in offsets]
+        if rows * cols > 1:
+            brightest[:, :, start:start + chunk] = np.max(shifted[:4] + shifted[5:], axis=0)
+        middle = _sort_pairs(list(shifted), _MEDIAN9)[4]
+        median[:, :, start:start + chunk] = middle
+        deviations = [np.abs(values - middle) for values in shifted]
+        deviation[:, :, start:start + chunk] = _sort_pairs(deviations, _MEDIAN9)[4]
+    return median, deviation, brightest
+
+
+def spectral_median(block):
+    """Median of every point and its two neighbours on either side along
+    the wavenumber axis, with the ends repeated outwards"""
+    padded = np.pad(block, ((0, 0), (0, 0), (2, 2)), mode='edge')
+    width = block.shape[2]
+    shifted = [padded[:, :, k:k + width] for k in range(5)]
+    return _sort_pairs(shifted, _MEDIAN5)[2]
+
+
+def robust_noise(block):
+    """Noise level of each spectrum of a block, from the robust standard
+    deviation (1.4826 times the median absolute value) of the differences of
+    neighbouring points, which bands and backgrounds barely move. Infinite
+    where it is zero."""
+    steps = np.abs(np.diff(block, axis=-1))
+    scale = 1.4826 / np.sqrt(2) * np.median(steps, axis=-1)[..., np.newaxis]
+    # Noise-free spectra (e.g. simulated or empty) cannot have outliers
+    scale[scale == 0] = np.inf
+    return scale
+
+
+def _despike_block(args):
+    """Pool worker: despikes X rows lo:hi of a block that carries halo rows
+    of neighbouring pixels on either side"""
+    block, mask, lo, hi, threshold = args
+    block = np.asarray(block, dtype=np.float64)
+    filled = block
+    if mask.any() and not mask.all():
+        # Pixels without a spectrum must not drag the spatial medians down
+        filled = block.copy()
+        filled[~mask] = np.median(block[mask], axis=0)
+    # Narrow features only: what stands out of the 5 point spectral median,
+    # one or two points wide. Backgrounds and broad bands drop out here.
+    narrow = filled - spectral_median(filled)
+    narrow_median, narrow_spread, narrow_brightest = [
+        values[lo:hi] for values in spatial_median(narrow)]
+    narrow = narrow[lo:hi]
+    noise = robust_noise(filled[lo:hi])
+    scale = np.maximum(1.4826 * narrow_spread, noise)
+    # A band that is narrow too shows up in some of the neighbours at the
+    # same wavenumber, with whatever heights. The pixel must then stand out
+    # against the strongest of them, a spike's neighbours show only noise.
+    shared = narrow_brightest > threshold / 2 * noise
+    scale[shared] = np.maximum(scale, narrow_brightest)[shared]
+    spikes = (narrow - narrow_median > threshold * scale) & (narrow > threshold * noise)
+    spikes &= mask[lo:hi, :, np.newaxis]
+
+    # Spikes get the spatial median, scaled to the overall level of the pixel
+    spatial = spatial_median(filled)[0][lo:hi]
+    block = block[lo:hi]
+    totals = spatial.sum(axis=-1)
+    totals[totals == 0] = 1.0
+    spatial *= (block.sum(axis=-1) / totals)[..., np.newaxis]
+    return np.where(spikes, spatial, block), spikes.sum(axis=-1)
+
+
+@profiled()
+def despike(collec, threshold=SPIKE_THRESHOLD, processes=None, cube_file=None, progress=None):
+    """
+    Removes cosmic-ray spikes from every spectrum of collec.
+
+    Only features one or two points wide count: what stands out of the
+    5 point spectral median of a spectrum by threshold times its noise.
+    Such a feature is a spike if it also stands out of the median of the
+    same wavenumber over the 3 x 3 neighbouring pixels (9 in a row on a
+    linescan) by threshold times their spread there, or times the strongest
+    of them if some neighbours show a narrow feature at that wavenumber too.
+    A band whose height varies between pixels is seen in the neighbours,
+    a spike is not. Spikes get the spatial median, scaled to the level of
+    the pixel. Blocks of X rows, with halo rows on either side, are filtered
+    in parallel worker processes.
+
+    Returns a new SpectrumCollection over the despiked cube (memory-mapped
+    from cube_file if given) and a (num_xs, num_ys) array counting the
+    points replaced in every pixel. progress(done, total) is called per block.
+    """
+    if collec.cube is None:
+        collec.build_cube()
+    blocks = row_blocks(collec)
+    # Along a line the neighbourhood reaches 4 pixels either way
+    halo = _neighbourhood(collec.num_xs, collec.num_ys)[0][0][0]
+    tasks = ((np.asarray(collec.cube[max(start - halo, 0):stop + halo]),
+              collec.mask[max(start - halo, 0):stop + halo],
+              start - max(start - halo, 0), stop - max(start - halo, 0), threshold)
+             for start, stop in blocks)
+    despiked = new_cube(collec, cube_file)
+    counts = np.zeros((collec.num_xs, collec.num_ys), dtype=int)
+    if len(blocks) < 2:
+        processes = 1
+    results = zip(blocks, map_blocks(_despike_block, tasks, processes))
+    for (start, stop), (block, spikes) in with_progress(results, len(blocks), progress):
+        despiked[start:stop] = block
+        counts[start:stop] = spikes
+    return collec.with_cube(despiked), counts
+
+
+def _savgol_block(args):
+    """Pool worker: Savitzky-Golay filters a block along the wavenumber axis"""
+    from scipy.signal import savgol_filter
+    block, window, polyorder, deriv, delta = args
+    return savgol_filter(block, window, polyorder, deriv=deriv, delta=delta, axis=-1,
+                         mode='interp')
+
+
+@profiled()
+def savgol(collec, window=11, polyorder=3, deriv=0, processes=None, cube_file=None,
+           progress=None):
+    """
+    Savitzky-Golay smoothing of every spectrum of collec: a least squares
+    polynomial of order polyorder is fitted over window points around each
+    wavenumber. With deriv 1 or 2 the first or second derivative of the
+    fit is taken instead, per unit of wavenumber (the axis is taken as
+    evenly spaced). Blocks of X rows are filtered in parallel worker
+    processes. Returns a new SpectrumCollection over the filtered cube
+    (memory-mapped from cube_file if given), which heatmaps and exports
+    use like any other. progress(done, total) is called per block.
+    """
+    if collec.cube is None:
+        collec.build_cube()
+    num = len(collec.wavenums)
+    if window % 2 == 0 or window <= polyorder:
+        raise ValueError("window must be odd and larger than polyorder")
+    if window > num:
+        raise ValueError("window of {} points is longer than the {} wavenumbers".format(
+            window, num))
+    if deriv > polyorder:
+        raise ValueError("deriv cannot exceed polyorder")
+    # Signed, so that derivatives of descending axes are still d/d(wavenum)
+    delta = (collec.wavenums[-1] - collec.wavenums[0]) / (num - 1) if num > 1 else 1.0
+    blocks = row_blocks(collec)
+    tasks = ((np.asarray(collec.cube[start:stop]), window, polyorder, deriv, delta)
+             for start, stop in blocks)
+    filtered = new_cube(collec, cube_file)
+    if len(blocks) < 2:
+        processes = 1
+    results = zip(blocks, map_blocks(_savgol_block, tasks, processes))
+    for (start, stop), block in with_progress(results, len(blocks), progress):
+        # Pixels without a spectrum stay empty
+        block[~collec.mask[start:stop]] = 0
+        filtered[start:stop] = block
+    return collec.with_cube(filtered)
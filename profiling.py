@@ -0,0 +1,194 @@
+"""
+Per-stage timing and memory instrumentation.
+
+Stages are marked with the stage context manager or the profiled decorator
+and record call counts, wall time and, where tracemalloc is available, the
+peak of memory allocated while they ran. Instrumentation is off unless
+enabled, and then costs one flag check per stage.
+
+Set PYSPECTRUM_PROFILE to switch it on for a whole run:
+
+    PYSPECTRUM_PROFILE=log          print the summary to stderr at exit
+    PYSPECTRUM_PROFILE=stages.json  write the summary as JSON at exit
+
+or call enable() and read summary() from code. Stages that run in worker
+processes are not recorded; load with processes=1 to see the per-file
+stages. Memory peaks are process wide, so work in other threads counts
+towards the stages running at the same time.
+"""
+from __future__ import print_function
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+#: Environment variable switching instrumentation on, see the module docstring
+PROFILE_ENV = "PYSPECTRUM_PROFILE"
+
+_enabled = False
+_memory = False
+_lock = threading.Lock()
+# Stage name -> [calls, total seconds, max seconds, peak bytes or None]
+_stats = {}
+# Stages entered and not yet left, per thread
+_local = threading.local()
+
+
+class _Stage(object):
+    """Context manager recording one run of a stage"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.traced = _memory
+        self.peak = 0
+        if self.traced:
+            stack = _stack()
+            current, peak = tracemalloc.get_traced_memory()
+            # The enclosing stages keep the peak reached so far
+            for outer in stack:
+                outer.peak = max(outer.peak, peak - outer.base)
+            tracemalloc.reset_peak()
+            self.base = current
+            stack.append(self)
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = timeit.default_timer() - self.start
+        if self.traced and tracemalloc.is_tracing():
+            stack = _stack()
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak = max(self.peak, peak - self.base)
+            if stack and stack[-1] is self:
+                stack.pop()
+        with _lock:
+            stats = _stats.setdefault(self.name, [0, 0.0, 0.0, None])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            if self.traced:
+                stats[3] = max(stats[3] or 0, self.peak)
+        return False
+
+
+class _NullStage(object):
+    """Stands in for _Stage while instrumentation is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def stage(name):
+    """Context manager timing the enclosed block as stage name"""
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+def profiled(name=None):
+    """Decorator timing every call of a function as a stage, named
+    module.function unless name is given"""
+    def decorate(func):
+        stage_name = name or "{}.{}".format(func.__module__,
+                                            getattr(func, "__qualname__", func.__name__))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def enable(memory=True):
+    """Starts recording stages, with their memory peaks if memory is True
+    and tracemalloc can report them"""
+    global _enabled, _memory
+    _memory = bool(memory and tracemalloc is not None and hasattr(tracemalloc, "reset_peak"))
+    if _memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+
+def disable():
+    """Stops recording stages, what was recorded is kept"""
+    global _enabled, _memory
+    _enabled = False
+    if _memory:
+        tracemalloc.stop()
+    _memory = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forgets everything recorded so far"""
+    with _lock:
+        _stats.clear()
+
+
+def summary():
+    """Returns stage name -> {"calls", "total", "mean", "max", "peak_bytes"}
+    with times in seconds. peak_bytes is None when memory is not traced."""
+    with _lock:
+        items = [(name, list(stats)) for name, stats in _stats.items()]
+    return dict((name, {"calls": calls, "total": total, "mean": total / calls, "max": longest,
+                        "peak_bytes": peak})
+                for name, (calls, total, longest, peak) in items)
+
+
+def report():
+    """Formats the summary as a table, slowest stages first"""
+    lines = ["{:<52} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "stage", "calls", "total s", "mean s", "max s", "peak MiB")]
+    for name, stats in sorted(summary().items(), key=lambda item: -item[1]["total"]):
+        peak = stats["peak_bytes"]
+        lines.append("{:<52} {:>8} {:>10.4f} {:>10.4f} {:>10.4f} {:>10}".format(
+            name, stats["calls"], stats["total"], stats["mean"], stats["max"],
+            "-" if peak is None else "{:.1f}".format(peak / 1048576.0)))
+    return "\n".join(lines)
+
+
+def dump_json(filename):
+    """Writes the summary to filename as JSON"""
+    with open(filename, "w") as out:
+        json.dump(summary(), out, indent=2, sort_keys=True)
+
+
+def _report_at_exit(target):
+    if not _stats:
+        return
+    if target.lower().endswith(".json"):
+        dump_json(target)
+    else:
+        print(report(), file=sys.stderr)
+
+
+if os.environ.get(PROFILE_ENV):
+    enable()
+    atexit.register(_report_at_exit, os.environ[PROFILE_ENV])
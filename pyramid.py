@@ -0,0 +1,154 @@
+"""
+Multi-resolution pyramid of a map.
+
+Level n of the pyramid is the map binned 2**n times in each direction:
+every pixel holds the mean spectrum of the valid pixels of a 2x2 block of
+the level below, at the mean of their coordinates. Levels are ordinary
+SpectrumCollections over the binned cube, so heatmaps, images and spectra
+come from them with the usual methods at a fraction of the pixels.
+SpectrumCollection.pyramid builds the levels on first use and keeps them.
+
+The viewers draw the coarsest level that still has a pixel per screen pixel
+(level_for_view) and integrate only the visible part of a finer level as
+the view is zoomed in (region_heatmap). Band integrals are not linear in
+the intensities, so a coarse heatmap is the integral of the binned spectra
+rather than the binned integral: a preview, exact again at level 0.
+"""
+from collections import OrderedDict
+import numpy as np
+from parallel import with_progress
+from preprocessing import new_cube
+from profiling import profiled
+
+#: Levels are added until the map is at most this many pixels each way
+MIN_SIZE = 64
+
+#: Upper bound on the bytes of cube data binned in one step
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def level_shape(num_xs, num_ys, level):
+    """(num_xs, num_ys) of level of the pyramid of a num_xs by num_ys map"""
+    scale = 2 ** level
+    return -(-num_xs // scale), -(-num_ys // scale)
+
+
+def num_levels(num_xs, num_ys):
+    """Number of levels in the pyramid of a num_xs by num_ys map, the map
+    itself (level 0) included"""
+    levels = 1
+    while max(level_shape(num_xs, num_ys, levels - 1)) > MIN_SIZE:
+        levels += 1
+    return levels
+
+
+def level_for_view(data_width, data_height, view_width, view_height, levels=None):
+    """Coarsest level at which data_width by data_height pixels of the full
+    map still cover view_width by view_height screen pixels, capped at the
+    last of levels"""
+    ratio = min(float(data_width) / max(view_width, 1), float(data_height) / max(view_height, 1))
+    level = int(np.floor(np.log2(ratio))) if ratio >= 2 else 0
+    return level if levels is None else min(level, levels - 1)
+
+
+def bin_pixels(cube, mask):
+    """
+    Bins a (rows, cols, n) block of a cube 2x2: returns the mean over the
+    pixels where mask is True of every bin, shaped (rows / 2, cols / 2, n)
+    rounded up, and the mask of the bins holding any such pixel. Bins
+    without one are zero.
+    """
+    rows, cols = mask.shape
+    weights = mask.astype(np.float64)
+    if rows % 2 or cols % 2:
+        # Odd edges are binned with the pixels that are there
+        pad = ((0, rows % 2), (0, cols % 2))
+        weights = np.pad(weights, pad, mode='constant')
+        cube = np.pad(cube, pad + ((0, 0),), mode='constant')
+    half_rows, half_cols = weights.shape[0] // 2, weights.shape[1] // 2
+    sums = (cube * weights[:, :, np.newaxis]).reshape(
+        half_rows, 2, half_cols, 2, cube.shape[2]).sum(axis=(1, 3))
+    counts = weights.reshape(half_rows, 2, half_cols, 2).sum(axis=(1, 3))
+    return sums / np.maximum(counts, 1)[:, :, np.newaxis], counts > 0
+
+
+@profiled()
+def coarser(collec, cube_file=None, progress=None):
+    """
+    Returns the next level of the pyramid above collec: a SpectrumCollection
+    of half the pixels each way, its cube memory-mapped from cube_file if
+    given. The cube is binned a block of X rows at a time, calling
+    progress(done, total) per block.
+    """
+    from pyspec import SpectrumCollection, CubeSpectra, axes_filename
+    grid = collec.grid
+    ones = np.ones((collec.num_xs, 1), dtype=bool)
+    bin_xs = bin_pixels(grid.xs[:, np.newaxis, np.newaxis], ones)[0][:, 0, 0]
+    ys = np.zeros((collec.num_xs, collec.num_ys, 1))
+    ys[grid.pixel_i, grid.pixel_j, 0] = grid.point_ys
+    bin_ys, mask = bin_pixels(ys, collec.mask)
+    x_to_y = OrderedDict()
+    for i, x in enumerate(bin_xs.tolist()):
+        # Pixels fill every column from j = 0 on, so the valid bins do too
+        # and the bin of the j-th Y of a column is the j-th pixel
+        x_to_y[x] = bin_ys[i, mask[i], 0].tolist()
+
+    shape = mask.shape + (collec.cube.shape[2],)
+    cube = new_cube(collec, cube_file, shape)
+    row_bytes = max(1, collec.num_ys * shape[2] * collec.cube.itemsize)
+    # An even number of rows, so blocks never split a bin
+    rows = max(2, BLOCK_BYTES // row_bytes) // 2 * 2
+    starts = range(0, collec.num_xs, rows)
+    for start in with_progress(starts, len(starts), progress):
+        block = bin_pixels(np.asarray(collec.cube[start:start + rows], dtype=np.float64),
+                           collec.mask[start:start + rows])[0]
+        cube[start // 2:start // 2 + len(block)] = block
+
+    level = SpectrumCollection(None, x_to_y)
+    level.cube = cube
+    level.wavenums = collec.wavenums
+    level.mask = mask
+    level.spectra = CubeSpectra(level)
+    if cube_file is not None:
+        cube.flush()
+        level.save_axes(axes_filename(cube_file))
+    return level
+
+
+def visible_pixels(collec, level, x_range, y_range):
+    """
+    Pixel range ((i0, i1), (j0, j1)) of level of the pyramid of collec that
+    covers x_range by y_range of the heatmap of collec, in the display
+    coordinates of its get_heatmap_array (x = i, y = num_ys - 1 - j)
+    """
+    scale = 2 ** level
+    num_xs, num_ys = level_shape(collec.num_xs, collec.num_ys, level)
+    x0, x1 = sorted(x_range)
+    y0, y1 = sorted(y_range)
+    i0 = int(np.floor((x0 + 0.5) / scale))
+    i1 = int(np.ceil((x1 + 0.5) / scale))
+    j0 = int(np.floor((collec.num_ys - 0.5 - y1) / scale))
+    j1 = int(np.ceil((collec.num_ys - 0.5 - y0) / scale))
+    return ((min(max(i0, 0), num_xs), min(max(i1, 0), num_xs)),
+            (min(max(j0, 0), num_ys), min(max(j1, 0), num_ys)))
+
+
+def extent(collec, level, rows, cols):
+    """imshow extent (left, right, bottom, top) placing the heatmap of
+    pixels rows by cols of level over the heatmap of collec"""
+    scale = 2 ** level
+    return (rows[0] * scale - 0.5, rows[1] * scale - 0.5,
+            collec.num_ys - cols[1] * scale - 0.5, collec.num_ys - cols[0] * scale - 0.5)
+
+
+@profiled()
+def region_heatmap(collec, wnum_1, wnum_2, rows, cols):
+    """get_heatmap_array of collec restricted to the pixels i in range(*rows)
+    and j in range(*cols), reading only that part of the cube"""
+    from pyspec import trapezoidal_sums
+    window = np.flatnonzero((collec.wavenums > wnum_1) & (collec.wavenums < wnum_2))
+    if len(window) and window[-1] - window[0] + 1 == len(window):
+        window = slice(window[0], window[-1] + 1)
+    culled = np.asarray(collec.cube[rows[0]:rows[1], cols[0]:cols[1]][:, :, window],
+                        dtype=np.float64)
+    return np.rot90(trapezoidal_sums(culled))
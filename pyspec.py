@@ -1,64 +1,519 @@
 """
-TODO: Module documentation
+Core data model of PySpectrum: SpectrumData, SpectrumCollection and the
+area scan and linescan loaders.
+
+Only NumPy is imported at load time, so worker processes and scripts start
+quickly and need no display. matplotlib, SciPy and the Qt GUI are imported
+by the functions that use them.
 """
 from __future__ import print_function
-import csv
 import os
 import sys
 import re
-import bisect
-from operator import itemgetter, attrgetter
+import threading
+import time
+import warnings
+from io import StringIO
+from multiprocessing import Pool, cpu_count
+from operator import attrgetter
 from collections import OrderedDict
 import numpy as np
-from matplotlib import pyplot as plt
-from PIL import Image
-from PySide import QtGui
-from scipy import stats
-from mplgui import PlotDisplay
-from directory_dialog import DialogGUIBox
+from preprocessing import (rubberband_correct, despike, savgol, shared_axis, common_axis,
+                           range_axis, resample, resample_spectra, AXIS_ATOL, AXIS_BLOCK,
+                           SPIKE_THRESHOLD)
+from parallel import with_progress
+from export import export_stack
+from profiling import profiled, stage
+
+#: Matches the X_/Y_ stage coordinates embedded in area scan file names
+XY_PATTERN = re.compile(r'[+-]?[XY]_.[0-9]+\.[0-9]+')
+
+#: Area scan directories smaller than this are parsed without a process pool
+MIN_POOL_FILES = 64
+
+#: Number of characters read per block when streaming a linescan file
+LINE_FILE_BLOCK_SIZE = 8 * 1024 * 1024
+
+#: Upper bound on the bytes of cube data read at once by the chunked paths
+CUBE_CHUNK_BYTES = 256 * 1024 * 1024
+
+#: Cube dtype of compact collections, see SpectrumCollection.compact
+COMPACT_DTYPE = np.float32
+
+#: Heatmap integrals of a compact cube stay within this fraction of the
+#: largest float64 value (checked by benchmark.py)
+COMPACT_RTOL = 1e-4
+
+
+def xy_grid(xs, ys):
+    """Groups X/Y coordinates into the X -> sorted Ys mapping used by
+    SpectrumCollection, in O(N log N)"""
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    order = np.lexsort((ys, xs))
+    sorted_xs = xs[order]
+    sorted_ys = ys[order]
+    x_starts = np.flatnonzero(np.concatenate(([True], sorted_xs[1:] != sorted_xs[:-1])))
+    x_to_y = OrderedDict()
+    bounds = x_starts.tolist() + [len(order)]
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        x_to_y[sorted_xs[first].item()] = sorted_ys[first:last].tolist()
+    return x_to_y
+
+
+class GridIndex(object):
+    """
+    Lookup from X/Y coordinates to (i, j) pixel grid locations, built once
+    from the X -> sorted Ys mapping of a collection. Repeated points map to
+    the first of their Ys, as bisect_left did.
+    """
+
+    @profiled("pyspec.GridIndex.__init__")
+    def __init__(self, x_to_y):
+        #: Sorted distinct Xs, i is the position in this array
+        self.xs = np.array(list(x_to_y.keys()), dtype=float)
+        counts = np.array([len(y_list) for y_list in x_to_y.values()], dtype=np.intp)
+        #: Coordinates of every point, in x_to_y order
+        self.point_xs = np.repeat(self.xs, counts)
+        self.point_ys = np.array([y for y_list in x_to_y.values() for y in y_list], dtype=float)
+        self.row_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+        # Points sort by (i, rank of Y), so one searchsorted finds both
+        self.unique_ys = np.unique(self.point_ys)
+        #: Pixel location of every point, in x_to_y order
+        self.pixel_i = np.repeat(np.arange(len(counts)), counts)
+        ranks = np.searchsorted(self.unique_ys, self.point_ys)
+        self.keys = self.pixel_i * len(self.unique_ys) + ranks
+        self.pixel_j = np.searchsorted(self.keys, self.keys) - self.row_starts[self.pixel_i]
+        #: True when every X has the same Ys, so that j is the rank of Y
+        self.regular = bool(np.array_equal(self.pixel_j, ranks))
+        # Hash map for scalar lookups, built on first use
+        self._pixels = None
+
+    def pixel(self, x, y):
+        """Returns the (i, j) pixel of x,y, raising ValueError if it is not in the grid"""
+        if self._pixels is None:
+            self._pixels = dict(zip(zip(self.point_xs.tolist(), self.point_ys.tolist()),
+                                    zip(self.pixel_i.tolist(), self.pixel_j.tolist())))
+        try:
+            return self._pixels[(x, y)]
+        except KeyError:
+            raise ValueError("X = {}, Y = {} is not in the collection".format(x, y))
+
+    @profiled("pyspec.GridIndex.pixels")
+    def pixels(self, xs, ys):
+        """Vectorized pixel: returns arrays of i and j for arrays of Xs and Ys"""
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        i = np.minimum(np.searchsorted(self.xs, xs), len(self.xs) - 1)
+        ranks = np.minimum(np.searchsorted(self.unique_ys, ys), len(self.unique_ys) - 1)
+        keys = i * len(self.unique_ys) + ranks
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        valid = (self.xs[i] == xs) & (self.unique_ys[ranks] == ys) & (self.keys[found] == keys)
+        if not np.all(valid):
+            raise ValueError("{} coordinates are not in the collection".format(
+                np.size(valid) - np.count_nonzero(valid)))
+        return i, found - self.row_starts[i]
+
+
+def axes_filename(cube_file):
+    """Name of the file holding the axes and coordinates of a saved cube"""
+    return os.path.splitext(cube_file)[0] + "_axes.npz"
+
+
+class CubeSpectra(object):
+    """
+    Read-only sequence of the SpectrumData objects of a collection that only
+    holds a cube. Spectra are built from the cube when accessed, so a
+    memory-mapped cube is paged in one spectrum at a time.
+    """
+
+    def __init__(self, collec):
+        self.collec = collec
+
+    def __len__(self):
+        return len(self.collec.grid.point_xs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[k] for k in range(*index.indices(len(self)))]
+        grid = self.collec.grid
+        intens = self.collec.cube[grid.pixel_i[index], grid.pixel_j[index]]
+        return SpectrumData(grid.point_xs[index].item(), grid.point_ys[index].item(),
+                            np.column_stack((self.collec.wavenums, intens)))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
 
 class SpectrumCollection(object):
 
-    def __init__(self, spectra, x_to_y):
+    def __init__(self, spectra, x_to_y, grid=None):
         #: List of SpectrumData objects
         self.spectra = spectra
         #: Mapping of Xs to Ys for the speectra
         self.x_to_y = x_to_y
+        #: Coordinate to pixel lookup, shared by collections on the same grid
+        self.grid = GridIndex(x_to_y) if grid is None else grid
         self.num_xs = len(self.x_to_y.keys())
         # Find number of ys
         biggest = 0
         for y_list in self.x_to_y.values():
             biggest = len(y_list) if len(y_list) > biggest else biggest
         self.num_ys = biggest
+        #: Optional dense (num_xs, num_ys, n_wavenums) intensity cube, see build_cube
+        self.cube = None
+        #: Wavenumber axis shared by every spectrum in the cube
+        self.wavenums = None
+        #: Boolean (num_xs, num_ys) array, True where a pixel holds a spectrum
+        self.mask = None
+        # (x, y) -> position in spectra, built on first get_spectrum without a cube
+        self._spectrum_index = None
+        # Cumulative trapezoid sums of the cube, built on first heatmap
+        self._integral_index = None
+        # Binned levels of the map, see pyramid; [self] once the first is built
+        self._pyramid = None
+        self._pyramid_lock = threading.Lock()
+        # Summed-area tables of the cube, built on first rectangle query
+        self._summed_area_tables = None
 
     @classmethod
-    def from_spectrum_data_list(cls, spectra):
-        """Creates a new SpectrumCollection object from a SpectrumData list"""
-        x_to_y = OrderedDict()
+    @profiled("pyspec.SpectrumCollection.from_spectrum_data_list")
+    def from_spectrum_data_list(cls, spectra, dense=False):
+        """Creates a new SpectrumCollection object from a SpectrumData list.
+        If dense is True, the intensity cube is built as well (see build_cube)"""
         # Sort the spectra by Y, then by X (relative ordering is maintained)
         spectra.sort(key=attrgetter("y"))
         spectra.sort(key=attrgetter("x"))
         # For all spectrum, build a map from xs to ys
-        for spectrum in spectra:
-            currx = spectrum.x
-            if currx not in x_to_y:
-                x_to_y[currx] = [spec.y for spec in spectra if spec.x == currx]
-        return SpectrumCollection(spectra, x_to_y)
+        x_to_y = xy_grid([spectrum.x for spectrum in spectra], [spectrum.y for spectrum in spectra])
+        collec = SpectrumCollection(spectra, x_to_y)
+        if dense:
+            collec.build_cube()
+        return collec
 
     def _xy_to_pixel(self, x, y):
         """Converts x,y coordinate to pixel grid location"""
-        # Check if x and y are in our spectra
-        if x not in self.x_to_y:
-            raise ValueError
-        elif y not in self.x_to_y[x]:
-            raise ValueError
-        # Find absolute index of where x and y are in the spectra
-        x_coord = bisect.bisect_left(list(self.x_to_y.keys()), x)
-        y_coord = bisect.bisect_left(self.x_to_y[x], y)
-        return (x_coord, y_coord)
+        return self.grid.pixel(x, y)
+
+    @classmethod
+    @profiled("pyspec.SpectrumCollection.from_stream")
+    def from_stream(cls, coords, parse, cube_file=None, dtype=np.float64):
+        """
+        Creates a SpectrumCollection whose cube is memory-mapped from
+        cube_file (or held in memory without one), writing each (X, Y, data)
+        item into it as it arrives instead of keeping SpectrumData objects.
+        parse() returns an iterator over the items, in the order of the X/Y
+        of coords. dtype is the dtype of the cube.
+
+        The cube gets the axis build_cube would choose. The items are
+        written on the axis of the first one; if some item has another axis,
+        parse() is called again and every item is resampled onto
+        preprocessing.common_axis, or ValueError is raised if the spectra
+        have no range in common.
+        """
+        xs, ys = zip(*coords)
+        collec = SpectrumCollection(None, xy_grid(xs, ys))
+        pixel_i, pixel_j = collec.grid.pixels(xs, ys)
+
+        def allocate(num_wavenums):
+            shape = (collec.num_xs, collec.num_ys, num_wavenums)
+            if cube_file is None:
+                return np.zeros(shape, dtype=dtype)
+            return np.lib.format.open_memmap(cube_file, mode='w+', dtype=dtype, shape=shape)
+
+        cube = wavenums = None
+        lows, highs, lengths = [], [], []
+        aligned = True
+        for k, (X, Y, data) in enumerate(parse()):
+            axis = data[:, 0]
+            lows.append(axis.min())
+            highs.append(axis.max())
+            lengths.append(len(axis))
+            if cube is None:
+                wavenums = axis
+                cube = allocate(len(wavenums))
+            if aligned and (len(axis) != len(wavenums) or
+                            np.abs(axis - wavenums).max() > AXIS_ATOL):
+                # Only the axis ranges are needed from the rest of this pass
+                aligned = False
+            if aligned:
+                cube[pixel_i[k], pixel_j[k]] = data[:, 1]
+        if not aligned:
+            wavenums = range_axis(lows, highs, lengths)
+            del cube
+            cube = allocate(len(wavenums))
+            for k, (X, Y, data) in enumerate(parse()):
+                cube[pixel_i[k], pixel_j[k]] = resample([data[:, 0]], [data[:, 1]], wavenums)[0]
+        collec.cube = cube
+        collec.wavenums = np.array(wavenums)
+        collec.mask = np.zeros((collec.num_xs, collec.num_ys), dtype=bool)
+        collec.mask[pixel_i, pixel_j] = True
+        collec.spectra = CubeSpectra(collec)
+        if cube_file is not None:
+            cube.flush()
+            collec.save_axes(axes_filename(cube_file))
+        return collec
+
+    @classmethod
+    def open_cube(cls, cube_file, mmap_mode='r'):
+        """Reopens a cube saved by build_cube or from_stream. By default the
+        cube is memory-mapped read-only and paged in as slices are used"""
+        with np.load(axes_filename(cube_file)) as axes:
+            wavenums = axes["wavenums"]
+            xs = axes["xs"]
+            ys = axes["ys"]
+            counts = axes["counts"]
+        x_to_y = OrderedDict()
+        for x, y_row, count in zip(xs.tolist(), ys, counts):
+            x_to_y[x] = y_row[:count].tolist()
+        collec = SpectrumCollection(None, x_to_y)
+        collec.cube = np.load(cube_file, mmap_mode=mmap_mode)
+        collec.wavenums = wavenums
+        collec.mask = np.arange(collec.num_ys) < counts[:, np.newaxis]
+        collec.spectra = CubeSpectra(collec)
+        return collec
+
+    def save_axes(self, filename):
+        """Saves the wavenumber axis and X/Y coordinates of the cube"""
+        counts = np.array([len(y_list) for y_list in self.x_to_y.values()])
+        ys = np.full((self.num_xs, self.num_ys), np.nan)
+        for i, y_list in enumerate(self.x_to_y.values()):
+            ys[i, :len(y_list)] = y_list
+        np.savez(filename, wavenums=self.wavenums, xs=np.array(list(self.x_to_y.keys())),
+                 ys=ys, counts=counts)
+
+    @profiled("pyspec.SpectrumCollection.build_cube")
+    def build_cube(self, filename=None, align=True, dtype=np.float64):
+        """Copies the intensities of every spectrum into one contiguous
+        (num_xs, num_ys, n_wavenums) array, so that single-wavenumber images
+        and per-pixel spectra become plain array slices.
+
+        When all spectra share one wavenumber axis (the axis of the last
+        spectrum, as in map_images) it becomes the cube axis. Otherwise every
+        spectrum is linearly resampled onto preprocessing.common_axis, or
+        ValueError is raised if align is False.
+        Pixels without a spectrum are left at zero and marked False in mask.
+        If filename is given the cube is a memory-mapped .npy file, which
+        open_cube can reopen later. dtype is the dtype of the cube.
+        """
+        wavenums = shared_axis(self.spectra)
+        aligned = wavenums is not None
+        if not aligned:
+            if not align:
+                raise ValueError("Spectra do not share a wavenumber axis")
+            wavenums = common_axis(self.spectra)
+        shape = (self.num_xs, self.num_ys, len(wavenums))
+        if filename is None:
+            cube = np.zeros(shape, dtype=dtype)
+        else:
+            cube = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+        mask = np.zeros((self.num_xs, self.num_ys), dtype=bool)
+        pixel_i, pixel_j = self.grid.pixels([spectrum.x for spectrum in self.spectra],
+                                            [spectrum.y for spectrum in self.spectra])
+        for start in range(0, len(self.spectra), AXIS_BLOCK):
+            block = self.spectra[start:start + AXIS_BLOCK]
+            if aligned:
+                intens = np.array([spectrum.info[0] for spectrum in block])
+            else:
+                intens = resample_spectra(block, wavenums)
+            stop = start + len(block)
+            cube[pixel_i[start:stop], pixel_j[start:stop]] = intens
+            mask[pixel_i[start:stop], pixel_j[start:stop]] = True
+        self.cube = cube
+        self.wavenums = np.array(wavenums)
+        self.mask = mask
+        self._integral_index = None
+        self._pyramid = None
+        self._summed_area_tables = None
+        if filename is not None:
+            cube.flush()
+            self.save_axes(axes_filename(filename))
+        return cube
+
+    def compact(self):
+        """
+        Switches the collection to compact storage: the cube is held as
+        COMPACT_DTYPE (built first if there is none) and the SpectrumData
+        objects are dropped, spectra come from the cube through CubeSpectra.
+        A memory-mapped cube is kept as it is, it takes no memory.
+        Heatmaps are then integrated in float64 from the cube, within
+        COMPACT_RTOL of the full precision ones. Returns the collection.
+        """
+        if self.cube is None:
+            self.build_cube(dtype=COMPACT_DTYPE)
+        elif self.cube.dtype != COMPACT_DTYPE and not isinstance(self.cube, np.memmap):
+            self.cube = self.cube.astype(COMPACT_DTYPE)
+        self.spectra = CubeSpectra(self)
+        self._spectrum_index = None
+        self._integral_index = None
+        self._pyramid = None
+        self._summed_area_tables = None
+        return self
+
+    def is_compact(self):
+        """True if the cube is held as COMPACT_DTYPE"""
+        return self.cube is not None and self.cube.dtype == COMPACT_DTYPE
+
+    def nbytes(self):
+        """
+        Memory held by the collection, as an OrderedDict of component name
+        to bytes with the sum under "total". Memory-mapped arrays are listed
+        under "<name> (mapped)" and left out of the total. "spectra" counts
+        the SpectrumData objects with their arrays, coordinates and Python
+        object overhead.
+        """
+        sizes = OrderedDict()
+
+        def add(name, array):
+            if array is None:
+                return
+            if isinstance(array, np.memmap):
+                name += " (mapped)"
+            sizes[name] = sizes.get(name, 0) + array.nbytes
+
+        add("cube", self.cube)
+        add("mask", self.mask)
+        add("wavenums", self.wavenums)
+        if isinstance(self.spectra, CubeSpectra):
+            sizes["spectra"] = 0
+        else:
+            sizes["spectra"] = sum(spectrum_nbytes(spectrum) for spectrum in self.spectra)
+        grid = self.grid
+        sizes["grid"] = sum(array.nbytes for array in (grid.xs, grid.point_xs, grid.point_ys,
+                                                        grid.row_starts, grid.unique_ys,
+                                                        grid.pixel_i, grid.pixel_j, grid.keys))
+        add("integral_index", self._integral_index)
+        for level in (self._pyramid or [])[1:]:
+            add("pyramid", level.cube)
+        if self._summed_area_tables is not None:
+            add("summed_area_tables", self._summed_area_tables.sums)
+            add("summed_area_tables", self._summed_area_tables.squares)
+        sizes["total"] = sum(size for name, size in sizes.items() if not name.endswith("(mapped)"))
+        return sizes
+
+    def with_cube(self, cube, wavenums=None):
+        """Returns a new SpectrumCollection on the same pixel grid whose
+        spectra come from cube, e.g. the output of a preprocessing stage"""
+        collec = SpectrumCollection(None, self.x_to_y, self.grid)
+        collec.cube = cube
+        collec.wavenums = self.wavenums if wavenums is None else np.asarray(wavenums)
+        collec.mask = self.mask
+        collec.spectra = CubeSpectra(collec)
+        return collec
+
+    def pyramid(self, level, progress=None):
+        """Returns level of the multi-resolution pyramid of the map, its cube
+        binned 2**level times each way (see pyramid.coarser). Level 0 is the
+        collection itself, levels past the coarsest give the coarsest. Levels
+        are built on first use and kept, memory-mapped next to the cube file
+        when the cube is."""
+        from pyramid import coarser, num_levels
+        level = min(level, num_levels(self.num_xs, self.num_ys) - 1)
+        # The viewers ask for levels from the GUI and background threads
+        with self._pyramid_lock:
+            if self._pyramid is None:
+                self._pyramid = [self]
+            while len(self._pyramid) <= level:
+                cube_file = None
+                if isinstance(self.cube, np.memmap) and self.cube.filename:
+                    cube_file = "{}_level{}.npy".format(
+                        os.path.splitext(self.cube.filename)[0], len(self._pyramid))
+                self._pyramid.append(coarser(self._pyramid[-1], cube_file, progress))
+            return self._pyramid[level]
+
+    def rubberband_corrected(self, processes=None, cube_file=None, progress=None):
+        """Returns a new collection with the rubberband baseline subtracted
+        from every spectrum (see preprocessing.rubberband_correct)"""
+        return rubberband_correct(self, processes, cube_file, progress)
+
+    def despiked(self, threshold=SPIKE_THRESHOLD, processes=None, cube_file=None, progress=None):
+        """Returns a new collection with cosmic-ray spikes replaced and the
+        per-pixel count of replaced points (see preprocessing.despike)"""
+        return despike(self, threshold, processes, cube_file, progress)
+
+    def smoothed(self, window=11, polyorder=3, deriv=0, processes=None, cube_file=None,
+                 progress=None):
+        """Returns a new collection of Savitzky-Golay smoothed spectra, or
+        their first or second derivative (see preprocessing.savgol)"""
+        return savgol(self, window, polyorder, deriv, processes, cube_file, progress)
+
+    def pca(self, n_components=5, progress=None):
+        """Principal component analysis of the map (see analysis.pca)"""
+        from analysis import pca
+        return pca(self, n_components, progress)
+
+    def kmeans(self, k=5, norm=None, progress=None, **options):
+        """Segments the map into k clusters of similar spectra (see
+        analysis.kmeans)"""
+        from analysis import kmeans
+        return kmeans(self, k, norm, progress=progress, **options)
+
+    def find_peaks(self, wnum_1, wnum_2, baseline=True, progress=None):
+        """Maps of the position, height, FWHM and area of the strongest peak
+        between wnum_1 and wnum_2 (see analysis.find_peaks)"""
+        from analysis import find_peaks
+        return find_peaks(self, wnum_1, wnum_2, baseline, progress)
+
+    def summed_area_tables(self, progress=None):
+        """Summed-area tables of the cube (see roi.summed_area_tables), built
+        on first use and kept, memory-mapped next to the cube file when the
+        cube is"""
+        if self._summed_area_tables is None:
+            from roi import summed_area_tables
+            sums_file = squares_file = None
+            if isinstance(self.cube, np.memmap) and self.cube.filename:
+                stem = os.path.splitext(self.cube.filename)[0]
+                sums_file, squares_file = stem + "_sums.npy", stem + "_squares.npy"
+            self._summed_area_tables = summed_area_tables(self, sums_file, squares_file,
+                                                          progress)
+        return self._summed_area_tables
+
+    def rectangle_stats(self, x_range, y_range, progress=None):
+        """Mean and standard deviation spectra of the spectra inside an X/Y
+        rectangle (see roi.rectangle_stats)"""
+        from roi import rectangle_stats
+        return rectangle_stats(self, x_range, y_range, progress)
 
+    def polygon_stats(self, vertices, progress=None):
+        """Mean and standard deviation spectra of the spectra inside a
+        polygon of X/Y vertices (see roi.polygon_stats)"""
+        from roi import polygon_stats
+        return polygon_stats(self, vertices, progress=progress)
+
+    def get_wavenums(self):
+        """Returns the wavenumber axis of the collection (the cube's, or the
+        last spectrum's when there is no cube)"""
+        if self.cube is not None:
+            return self.wavenums
+        return self.spectra[-1].info[1]
+
+    def get_spectrum(self, x, y):
+        """Returns the SpectrumData object at x,y in constant time"""
+        if self.cube is not None:
+            i, j = self._xy_to_pixel(x, y)
+            return SpectrumData(x, y, np.column_stack((self.wavenums, self.cube[i, j])))
+        if self._spectrum_index is None:
+            self._spectrum_index = dict(((spectrum.x, spectrum.y), k)
+                                        for k, spectrum in enumerate(self.spectra))
+        try:
+            return self.spectra[self._spectrum_index[(x, y)]]
+        except KeyError:
+            raise ValueError("X = {}, Y = {} is not in the collection".format(x, y))
+
+    def get_spectrum_array(self, x, y):
+        """Returns the intensities of the spectrum at x,y as a slice of the cube"""
+        i, j = self._xy_to_pixel(x, y)
+        return self.cube[i, j]
+
+    @profiled("pyspec.SpectrumCollection.get_img_array")
     def get_img_array(self, wavenum, linescan):
         """Constructs a numpy array containing the intesity at the wavenum"""
+        if self.cube is not None:
+            # Same lookup as SpectrumData.get_intens, done once for all pixels
+            indx = wavenum_indices(self.wavenums, wavenum)
+            img_array = self.cube[:, :, indx].copy()
+            return np.flipud(np.rot90(img_array))
         img_array = np.zeros((self.num_xs, self.num_ys))
         # Iterate through the spectra and get the intensity value at wavenum
         for spectrum in self.spectra:
@@ -66,43 +521,124 @@ class SpectrumCollection(object):
             img_array[i][j] = spectrum.get_intens(wavenum, linescan)
         return np.flipud(np.rot90(img_array))
 
-    def map_images(self):
-        """Constructs a greyscale image of intensity at each pixel, for each wavenum"""
-        wavenums = []
-        for spectrum in self.spectra:
-            wavenums = spectrum.info[1]
-        for wavenum in wavenums:
-            img_array = self.get_img_array(wavenum, linescan=False)
-            #im = Image.fromarray(img_array)
-            #im.save(str(wavenum) + ".tiff", "tiff")
-            plt.imshow(img_array, cmap="gray")
-            ax = plt.gca()
-            ax.invert_yaxis()
-            plt.savefig(str(wavenum) + ".tiff", bbox_inches='tight', dpi='figure')
-            plt.cla()
-
-    def get_heatmap_array(self, wnum_1, wnum_2):
+    def iter_img_arrays(self, wavenums, linescan):
+        """Yields (wavenum, img_array) for every wavenum, as get_img_array
+        would construct it. With a cube, the wavenumber slices are read in
+        blocks of at most CUBE_CHUNK_BYTES, so a memory-mapped cube is paged
+        in a few passes rather than once per image."""
+        if self.cube is None:
+            for wavenum in wavenums:
+                yield wavenum, self.get_img_array(wavenum, linescan)
+            return
+        indices = wavenum_indices(self.wavenums, wavenums)
+        block_size = max(1, CUBE_CHUNK_BYTES // (self.num_xs * self.num_ys * self.cube.itemsize))
+        for start in range(0, len(indices), block_size):
+            block = self.cube[:, :, indices[start:start + block_size]]
+            for k, wavenum in enumerate(wavenums[start:start + block_size]):
+                yield wavenum, np.flipud(np.rot90(block[:, :, k].copy()))
+
+    @profiled("pyspec.SpectrumCollection.map_images")
+    def map_images(self, wavenums=None, cmap="gray", multipage=None, progress=None):
+        """Constructs a greyscale image of intensity at each pixel, for each wavenum
+        (all of them by default), see export.export_stack"""
+        return export_stack(self, wavenums=wavenums, linescan=False, cmap=cmap,
+                            multipage=multipage, progress=progress)
+
+    @profiled("pyspec.SpectrumCollection.get_heatmap_array")
+    def get_heatmap_array(self, wnum_1, wnum_2, progress=None):
         """Constructs a numpy array containing the intesity at the wavenum"""
+        if self.cube is not None:
+            sums = None
+            # The index is a float64 copy of the cube, not kept for mapped or
+            # compact cubes
+            if not isinstance(self.cube, np.memmap) and self.cube.dtype == np.float64:
+                sums = self._indexed_trapezoidal_sums(wnum_1, wnum_2, progress)
+            if sums is None:
+                sums = self._cube_trapezoidal_sums(wnum_1, wnum_2, progress)
+            return np.rot90(sums)
         img_array = np.zeros((self.num_xs, self.num_ys))
         # Iterate through the spectra and get the intensity value at wavenum
-        for spectrum in self.spectra:
+        for spectrum in with_progress(self.spectra, len(self.spectra), progress):
             i, j = self._xy_to_pixel(spectrum.x, spectrum.y)
             img_array[i][j] = spectrum.trapezoidal_sum(wnum_1, wnum_2)
         return (np.rot90(img_array))
 
-    def gen_heatmap(self, wnum_1, wnum_2):
-        heatmap_array = self.get_heatmap_array(wnum_1, wnum_2)
+    def integral_index(self, progress=None):
+        """
+        Cumulative sums, along the wavenumber axis of the cube, of the
+        trapezoids that SpectrumData.trapezoidal_sum adds up. Shaped
+        (n_wavenums, num_xs, num_ys) so that each wavenumber is one
+        contiguous slice. Built on first use and kept, at the size of the
+        cube, so that every later band integral is a difference of two
+        slices.
+        """
+        if self._integral_index is None:
+            index = np.empty((len(self.wavenums), self.num_xs, self.num_ys))
+            index[0] = 0
+            row_bytes = max(1, self.num_ys * len(self.wavenums) * self.cube.itemsize)
+            rows = max(1, CUBE_CHUNK_BYTES // row_bytes)
+            starts = range(0, self.num_xs, rows)
+            for start in with_progress(starts, len(starts), progress):
+                block = np.asarray(self.cube[start:start + rows], dtype=np.float64)
+                dx = np.diff(block, axis=-1)
+                sums = np.cumsum(block[..., :-1] * dx + 0.5 * dx * dx, axis=-1)
+                index[1:, start:start + rows] = np.moveaxis(sums, -1, 0)
+            self._integral_index = index
+        return self._integral_index
+
+    def _indexed_trapezoidal_sums(self, wnum_1, wnum_2, progress=None):
+        """SpectrumData.trapezoidal_sum of every pixel from integral_index,
+        or None if the range is not one run of the wavenumber axis"""
+        window = np.flatnonzero((self.wavenums > wnum_1) & (self.wavenums < wnum_2))
+        if not len(window) or window[-1] - window[0] + 1 != len(window):
+            return None
+        first, last = window[0], window[-1]
+        if first == last:
+            return np.array(self.cube[:, :, first], dtype=np.float64)
+        index = self.integral_index(progress)
+        total_area = index[last] - index[first]
+        return total_area - lower_areas(self.cube[:, :, first], self.cube[:, :, last])
+
+    def _cube_trapezoidal_sums(self, wnum_1, wnum_2, progress=None):
+        """SpectrumData.trapezoidal_sum of every pixel, computed from the cube
+        a block of X rows at a time"""
+        window = np.flatnonzero((self.wavenums > wnum_1) & (self.wavenums < wnum_2))
+        if len(window) and window[-1] - window[0] + 1 == len(window):
+            # Sorted axis, read the range as a slice instead of a gather
+            window = slice(window[0], window[-1] + 1)
+            width = window.stop - window.start
+        else:
+            width = len(window)
+        sums = np.zeros((self.num_xs, self.num_ys))
+        rows = max(1, CUBE_CHUNK_BYTES // max(1, self.num_ys * width * self.cube.itemsize))
+        starts = range(0, self.num_xs, rows)
+        for start in with_progress(starts, len(starts), progress):
+            culled = self.cube[start:start + rows][:, :, window]
+            sums[start:start + rows] = trapezoidal_sums(culled)
+        return sums
+
+    @profiled("pyspec.SpectrumCollection.gen_heatmap")
+    def gen_heatmap(self, wnum_1, wnum_2, heatmap_array=None, extent=None):
+        """Draws the heatmap and saves it as heat_map.png. extent places a
+        heatmap of a pyramid level over the full map (see pyramid.extent)"""
+        if heatmap_array is None:
+            heatmap_array = self.get_heatmap_array(wnum_1, wnum_2)
+        from matplotlib import pyplot as plt
         # configure array so negative values changed to zero
         heatmap_array[heatmap_array < 0] = 0
-        hm = plt.imshow(heatmap_array, interpolation='bilinear', origin='lower', cmap='hot')
+        hm = plt.imshow(heatmap_array, interpolation='bilinear', origin='lower', cmap='hot',
+                        extent=extent)
         plt.colorbar(hm, orientation='horizontal')
         plt.savefig("heat_map.png", bbox_inches='tight')
 
-    def gen_heatmap_linescan(self, wnum_1, wnum_2):
-        heatmap_array = self.get_heatmap_array(wnum_1, wnum_2)
+    @profiled("pyspec.SpectrumCollection.gen_heatmap_linescan")
+    def gen_heatmap_linescan(self, wnum_1, wnum_2, heatmap_array=None):
+        if heatmap_array is None:
+            heatmap_array = self.get_heatmap_array(wnum_1, wnum_2)
         # if true aspect ratio is desired, use Image instead of imshow
         # im = Image.fromarray(heatmap_array)
         # im.save("heatmap.tiff", "tiff")
+        from matplotlib import pyplot as plt
         w, h = plt.figaspect(.1)
         plt.figure(figsize=(w, h))
         # configure array so negative values changed to zero
@@ -113,73 +649,50 @@ class SpectrumCollection(object):
         plt.colorbar(orientation='horizontal')
         plt.savefig("heat_map.png")
 
-    def map_linescan(self):
-        """Constructs a greyscale image of intensity at each pixel, for each wavenum (LINESCAN specific
-        uses PIL instead of matplotlib)"""
-        wavenums = []
-        for spectrum in self.spectra:
-            wavenums = spectrum.info[1]
-        for wavenum in wavenums:
-            img_array = self.get_img_array(wavenum, linescan=True)
-            w, h = plt.figaspect(0.1)
-            plt.figure(figsize=(w, h))
-            plt.pcolormesh(img_array, cmap='gray')
-            plt.yticks(np.arange(0, 1.1, 1))
-            plt.xlim(xmax=img_array.size)
-            plt.savefig(str(wavenum) + ".tiff", dpi='figure')
-            plt.cla()
-            #im = Image.fromarray(img_array)
-            #im.save(str(wavenum) + ".tiff", "tiff")
+    @profiled("pyspec.SpectrumCollection.map_linescan")
+    def map_linescan(self, wavenums=None, cmap="gray", multipage=None, progress=None):
+        """Constructs a greyscale image of intensity at each pixel, for each wavenum (LINESCAN specific,
+        rows are repeated to the 1:10 aspect of the former figures)"""
+        return export_stack(self, wavenums=wavenums, linescan=True, cmap=cmap,
+                            multipage=multipage, aspect=0.1, progress=progress)
 
 class SpectrumData(object):
     """ Object representing the spectrum at a single (X, Y) coordinate. """
 
+    # No per-object __dict__, maps hold millions of these
+    __slots__ = ("x", "y", "info")
+
     def __init__(self, x, y, info):
         self.x = x
         self.y = y
         self.info = np.array(info)
         self.info = np.rot90(self.info)
-        self.info_flipped = np.rot90(self.info, 3)
+
+    @property
+    def info_flipped(self):
+        """(n, 2) view of info as (wavenum, intensity) rows"""
+        return np.rot90(self.info, 3)
 
     @classmethod
     def from_file(cls, filename, filter_negative=True):
         """
         Loads file from directory ** needs input to be a fully qualified file
         path.
-        Returns a new list of tuples (x,y) containing points, where
-        x = wavenums and y = intensities.
+        Returns a new SpectrumData object whose points (x,y) are x = wavenums
+        and y = intensities, sorted by wavenum.
         """
-        data = []
-        # Read in files row by row
-        with open(filename, 'r') as csvfile:
-            numreader = csv.reader(csvfile, delimiter='\t')
-            for row in numreader:
-                # Filter out negatives if flag is on
-                if not (filter_negative and float(row[0]) < 0):
-                    data.append((float(row[0]), float(row[1])))
-        # Sort by wavenum (increasing)
-        data.sort(key=itemgetter(0))
-        # Find bigX and bigY in the file name, add to SpectrumData object
-        matches = re.findall('[+-]?[XY]_.[0-9]+\.[0-9]+', filename)
-        X = None
-        Y = None
-        for match in matches:
-            if "X_" in match:
-                X = match[2:]
-            if "Y_" in match:
-                Y = match[2:]
-
-        return SpectrumData(float(X), float(Y), data)
+        X, Y, data = _parse_area_file((filename, filter_negative))
+        return SpectrumData(X, Y, data)
 
     def get_intens(self, wavenum, linescan=False):
-        """Gets the intensity corresponding to the given wavenumber"""
+        """Gets the intensity corresponding to the given wavenumber. Linescan
+        spectra keep the descending axis of the file, see wavenum_indices;
+        linescan is accepted for compatibility, the lookup handles both."""
         # 'Flip' array so that we can get only the wavenumbers
         wavenums = self.info[1]
         # Find index of requested wavenumber
-        indx = np.searchsorted(wavenums, wavenum)
+        indx = wavenum_indices(wavenums, wavenum)
         # Return intensity at that indx
-        if linescan==True:
-            indx-=1
         return self.info[0][indx]
 
     def __repr__(self):
@@ -187,6 +700,7 @@ class SpectrumData(object):
 
     def plot_spectrum(self, show=False):
         """Creates x-y scatter plot of the spectrum data"""
+        from matplotlib import pyplot as plt
         plt.scatter(*zip(*self.info_flipped))
         plt.savefig("{}_{}_plot.png".format(self.x, self.y))
         if show:
@@ -230,8 +744,56 @@ class SpectrumData(object):
 
     def plot_spec(self):
         """Creates x-y scatter plot of the spectrum data"""
+        from matplotlib import pyplot as plt
         plt.scatter(*zip(*self.info_flipped))
 
+def spectrum_nbytes(spectrum):
+    """Bytes held by one SpectrumData object: the object, its coordinates,
+    and its info array with the views and data behind it"""
+    size = sys.getsizeof(spectrum) + sys.getsizeof(spectrum.x) + sys.getsizeof(spectrum.y)
+    array = spectrum.info
+    while True:
+        # getsizeof counts the data of arrays owning it, only the header of views
+        size += sys.getsizeof(array)
+        if not isinstance(array.base, np.ndarray):
+            break
+        array = array.base
+    if not array.flags.owndata:
+        size += array.nbytes
+    return size
+
+
+def wavenum_indices(axis, wavenums):
+    """Indices into axis of the points at wavenums, or else of the next
+    higher wavenumber (the last point past the end). The lookup goes through
+    the ascending order of axis, so descending axes, as linescans keep them
+    in file order, find the same points."""
+    axis = np.asarray(axis)
+    last = len(axis) - 1
+    if last > 0 and axis[0] > axis[-1]:
+        return last - np.minimum(np.searchsorted(axis[::-1], wavenums), last)
+    return np.minimum(np.searchsorted(axis, wavenums), last)
+
+
+def trapezoidal_sums(culled):
+    """Vectorized SpectrumData.trapezoidal_sum over the last axis of culled,
+    which holds the intensities inside the wavenumber range"""
+    # Compact float32 cubes are integrated in float64
+    culled = np.asarray(culled, dtype=np.float64)
+    if culled.shape[-1] == 1:
+        return culled[..., 0].copy()
+    dx = np.diff(culled, axis=-1)
+    total_area = (culled[..., :-1] * dx + 0.5 * dx * dx).sum(axis=-1)
+    return total_area - lower_areas(culled[..., 0], culled[..., -1])
+
+
+def lower_areas(first, last):
+    """subtract_lower for many spectra at once, from their first and last
+    intensities inside the wavenumber range"""
+    horiz = np.abs(np.asarray(last, dtype=np.float64) - first)
+    return horiz * horiz + 0.5 * horiz * horiz
+
+
 def subtract_lower(data):
     # Get min & max points according to x (assuming data is already sorted)
     p0 = data[0]
@@ -248,74 +810,270 @@ def subtract_lower(data):
     return total_area
 
 
+def parse_columns(text, ncols):
+    """Parses tab-separated numeric text into an (n, ncols) numpy array of
+    the first ncols columns"""
+    stripped = text.strip()
+    num_rows = stripped.count('\n') + 1 if stripped else 0
+    with warnings.catch_warnings():
+        # Older numpy only warns when it cannot parse the whole string
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(stripped, sep=' ')
+        except (ValueError, DeprecationWarning):
+            values = None
+    if values is None or values.size != num_rows * ncols:
+        # Extra columns, blank lines or malformed rows: loadtxt keeps the
+        # first ncols columns and reports where a malformed row is
+        values = np.loadtxt(StringIO(text), delimiter='\t', ndmin=2, usecols=range(ncols))
+    return values.reshape(-1, ncols)
+
+
+def read_spectrum_file(filename, filter_negative=True):
+    """Reads a two column (wavenum, intensity) tab-separated spectrum file
+    into an (n, 2) numpy array sorted by wavenum (increasing)"""
+    with stage("pyspec.read_spectrum_file (read)"):
+        with open(filename, 'r') as datafile:
+            text = datafile.read()
+    with stage("pyspec.read_spectrum_file (parse)"):
+        data = parse_columns(text, 2)
+    # Filter out negatives if flag is on
+    if filter_negative:
+        data = data[data[:, 0] >= 0]
+    # Stable sort, so points with equal wavenums keep their file order
+    return data[np.argsort(data[:, 0], kind='mergesort')]
+
+
+def xy_from_filename(filename):
+    """Finds bigX and bigY in an area scan file name"""
+    X = None
+    Y = None
+    for match in XY_PATTERN.findall(os.path.basename(filename)):
+        if "X_" in match:
+            X = match[2:]
+        if "Y_" in match:
+            Y = match[2:]
+    return float(X), float(Y)
+
+
+def _parse_area_file(args):
+    """Pool worker: parses one area scan file into (X, Y, data)"""
+    filename, filter_negative = args
+    X, Y = xy_from_filename(filename)
+    return X, Y, read_spectrum_file(filename, filter_negative)
+
+
+@profiled()
+def with_dense_cube(collec, compact=False):
+    """Builds the cube of collec, or switches it to compact storage (see
+    SpectrumCollection.compact). Spectra without a wavenumber range in
+    common are left without a cube, on per-spectrum lookups. Returns collec."""
+    try:
+        if compact:
+            collec.compact()
+        else:
+            collec.build_cube()
+    except ValueError:
+        pass
+    return collec
+
+
+def from_area_dir(path, filter_negative=True, processes=None, dense=True, verbose=False,
+                  cube_file=None, compact=False, progress=None):
+    """
+    Loads every .txt spectrum file of an area scan directory and builds the
+    SpectrumCollection in one pass.
+
+    Files are parsed in a pool of processes worker processes (all cores by
+    default, no pool for processes=1 or small directories). If cube_file is
+    given, spectra are written straight into a memory-mapped cube in that
+    file (see SpectrumCollection.from_stream), so the map does not have to
+    fit in memory. With compact, spectra are written straight into a
+    COMPACT_DTYPE cube (in memory without cube_file) and no SpectrumData
+    objects are made, see SpectrumCollection.compact. If verbose is True
+    the loading rate in files per second is printed. progress(done, total)
+    is called as files are parsed.
+    """
+    file_list = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".txt")]
+    tasks = [(filename, filter_negative) for filename in file_list]
+    start = time.time()
+    pool = None
+    if processes != 1 and len(tasks) >= MIN_POOL_FILES:
+        processes = processes or cpu_count()
+        pool = Pool(processes)
+    completed = False
+
+    def parse():
+        if pool is None:
+            parsed = (_parse_area_file(task) for task in tasks)
+        else:
+            parsed = pool.imap(_parse_area_file, tasks, max(1, len(tasks) // (4 * processes)))
+        return with_progress(parsed, len(tasks), progress)
+
+    try:
+        if cube_file is not None or compact:
+            coords = [xy_from_filename(filename) for filename in file_list]
+            collec = SpectrumCollection.from_stream(coords, parse, cube_file,
+                                                    COMPACT_DTYPE if compact else np.float64)
+        else:
+            spectra = [SpectrumData(X, Y, data) for X, Y, data in parse()]
+            collec = SpectrumCollection.from_spectrum_data_list(spectra)
+        completed = True
+    finally:
+        if pool is not None:
+            # A cancelled load must not wait for the remaining files
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+    if dense and collec.cube is None:
+        with_dense_cube(collec)
+    if verbose:
+        elapsed = time.time() - start
+        print("Loaded {} files in {:.2f} s ({:.0f} files/s)".format(
+            len(tasks), elapsed, len(tasks) / elapsed if elapsed > 0 else float('inf')))
+    return collec
+
+
 def lin_reg(x_vals, y_vals):
     """Performs linear regression analysis on points in data, where x_vals is a list
     of the x values and y_vals is a list of the respective y values"""
+    from scipy import stats
 
     slope, intercept, r_value, p_value, std_err = stats.linregress(x_vals, y_vals)
 
     return slope, intercept
 
 
-def from_line_file(filename, filter_negative=True):
+def _line_spectrum(rows, filter_negative):
+    """Makes a SpectrumData object out of the (X, Y, wavenum, intensity) rows
+    of one linescan point, or None if filtering leaves no data"""
+    data = rows[:, 2:]
+    if filter_negative:
+        data = data[data[:, 0] >= 0]
+    if len(data) == 0:
+        return None
+    return SpectrumData(rows[0, 0], rows[0, 1], data)
+
+
+def iter_line_file(filename, filter_negative=True, block_size=LINE_FILE_BLOCK_SIZE,
+                   progress=None):
     """
-    Loads file from directory ** needs input to be a fully qualified file
-    path.
-    Returns a new list of tuples (x,y) containing points, where
-    x = wavenums and y = intensities.
+    Yields the SpectrumData objects of a linescan file one at a time.
+
+    The tab-separated (X, Y, wavenum, intensity) rows are read in blocks of
+    block_size characters and split wherever X or Y changes, so memory use
+    is bounded by the block size rather than by the file size.
+    progress(done, total) is called with the characters read after each block.
     """
-    spectra = []
-    # Read in files row by row
-    with open(filename, 'r') as csvfile:
-        numreader = csv.reader(csvfile, delimiter='\t')
-        data = []
-        last_seen_xy = None
-        for row in numreader:
-            # First row - just use the first X/Y we see
-            if last_seen_xy is None:
-                last_seen_xy = (float(row[0]), float(row[1]))
+    total = os.path.getsize(filename)
+    done = 0
+    # Rows of the last spectrum of a block, which may continue in the next one
+    pending = np.empty((0, 4))
+    # Partial line at the end of a block
+    tail = ''
+    with open(filename, 'r') as linefile:
+        while True:
+            with stage("pyspec.iter_line_file (read)"):
+                block = linefile.read(block_size)
+            if not block:
+                text = tail
+                tail = ''
             else:
-                # Check if current row X/Y is the same as the last one we saw
-                new_xy = (float(row[0]), float(row[1]))
-                # If they are different, make a data object out of the data we've collected so far
-                if last_seen_xy[0] != new_xy[0] or last_seen_xy[1] != new_xy[1]:
-                    data_obj = SpectrumData(last_seen_xy[0], last_seen_xy[1], data)
-                    spectra.append(data_obj)
-                    last_seen_xy = new_xy
-                    data = []
-            if not (filter_negative and float(row[2]) < 0):
-                data.append((float(row[2]), float(row[3])))
+                cut = block.rfind('\n') + 1
+                text = tail + block[:cut] if cut else ''
+                tail = block[cut:] if cut else tail + block
+            with stage("pyspec.iter_line_file (parse)"):
+                rows = parse_columns(text, 4) if text.strip() else np.empty((0, 4))
+            rows = np.concatenate((pending, rows)) if len(pending) else rows
+            # Start index of every run of rows sharing the same X/Y
+            starts = np.flatnonzero((rows[1:, :2] != rows[:-1, :2]).any(axis=1)) + 1
+            bounds = [0] + starts.tolist()
+            for first, last in zip(bounds[:-1], bounds[1:]):
+                spectrum = _line_spectrum(rows[first:last], filter_negative)
+                if spectrum is not None:
+                    yield spectrum
+            pending = rows[bounds[-1]:]
+            if not block:
+                break
+            done += len(block)
+            if progress is not None:
+                progress(min(done, total), total)
     # Once file ends, make a SpectrumData object with remaining data
-    if len(data) > 0:
-        spectra.append(SpectrumData(last_seen_xy[0], last_seen_xy[1], data))
+    if len(pending) > 0:
+        spectrum = _line_spectrum(pending, filter_negative)
+        if spectrum is not None:
+            yield spectrum
+
+
+@profiled()
+def from_line_file(filename, filter_negative=True, cube_file=None, compact=False,
+                   progress=None):
+    """
+    Loads linescan single file from directory
+    ** needs input to be a fully qualified file path.
+    Returns a SpectrumCollection with one SpectrumData object per X/Y point.
+    If cube_file is given, the file is read twice (coordinates, then data,
+    and once more if the spectra do not share an axis, see from_stream)
+    and the spectra are written straight into a memory-mapped cube. So are
+    they with compact, into a COMPACT_DTYPE cube in memory without cube_file.
+    """
+    if cube_file is not None or compact:
+        # Each pass is reported as one half of the work
+        first_half = None if progress is None else lambda done, total: progress(done, 2 * total)
+        second_half = None if progress is None else lambda done, total: progress(total + done, 2 * total)
+        coords = [(spectrum.x, spectrum.y)
+                  for spectrum in iter_line_file(filename, filter_negative, progress=first_half)]
+
+        def parse():
+            return ((spectrum.x, spectrum.y, spectrum.info_flipped)
+                    for spectrum in iter_line_file(filename, filter_negative,
+                                                   progress=second_half))
+        return SpectrumCollection.from_stream(coords, parse, cube_file,
+                                              COMPACT_DTYPE if compact else np.float64)
+    spectra = list(iter_line_file(filename, filter_negative, progress=progress))
     # Use this method which builds the X->Y mapping for us into the SpectrumCollection object
     return SpectrumCollection.from_spectrum_data_list(spectra)
 
+#: Main windows opened by build_plot_display, kept referenced until closed
+windows = []
+
 def build_plot_display(path, linescan=False):
-    """Parses the data from the directory path selected in main,
-    then creates main GUI window"""
-    if linescan==True:
-        file_list = [f for f in os.listdir(path) if f.endswith(".txt")]
-        os.chdir(path)
-        collec = from_line_file(path + "/"  + str(file_list[0]))
-        heatmap = collec.gen_heatmap_linescan
-        map = collec.map_linescan
-    else:
-        file_list = [f for f in sorted(os.listdir(path)) if f.endswith(".txt")]
+    """Parses the data from the directory path selected in main in a
+    background thread, then creates main GUI window. Returns the loading Task"""
+    # Imported here so that batch processing never loads Qt, and because
+    # scan_cache itself builds on this module
+    from PySide import QtCore
+    from mplgui import PlotDisplay
+    from workers import run_task
+    from scan_cache import load_scan
+
+    def show(collec):
         os.chdir(path)
-        spectra = []
-        for each in file_list:
-            spectra.append(SpectrumData.from_file(each))
-        collec = SpectrumCollection.from_spectrum_data_list(spectra)
-        heatmap = collec.gen_heatmap
-        map = collec.map_images
-
-    # Create the window with the collection, show and run
-    window = PlotDisplay(collec, heatmap, map, path)
-    window.setWindowTitle("PySpectrum Analyzer")
-    window.show()
+        if linescan==True:
+            heatmap = collec.gen_heatmap_linescan
+            map = collec.map_linescan
+        else:
+            heatmap = collec.gen_heatmap
+            map = collec.map_images
+
+        # Create the window with the collection, show and run
+        window = PlotDisplay(collec, heatmap, map, path, linescan)
+        window.setWindowTitle("PySpectrum Analyzer")
+        # Qt deletes the window once it is closed, then the collection it
+        # holds can go too
+        window.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        window.destroyed.connect(lambda obj=None: windows.remove(window))
+        window.show()
+        windows.append(window)
+
+    return run_task(None, "Loading {}".format(path), show, load_scan, path, linescan, verbose=True)
 
 def main(path):
+    from PySide import QtGui
+    from directory_dialog import DialogGUIBox
+
     # Must construct application first
     app = QtGui.QApplication(sys.argv)
 
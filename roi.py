@@ -0,0 +1,208 @@
+"""
+Mean and standard deviation spectra of regions of a map.
+
+Rectangles are answered from the summed-area tables of the cube (see
+summed_area_tables): cumulative sums of the intensities and of their
+squares over both pixel axes, so the sums over any rectangle take four
+lookups per wavenumber whatever its size. Polygons become a pixel mask
+through a vectorized point-in-polygon test, and only the X rows they span
+are read.
+
+Regions are given in X/Y coordinates (rectangle_stats, polygon_stats), in
+(i, j) pixels (pixel_rectangle_stats, polygon_mask with pixels=True) or in
+the display coordinates of a heatmap (heatmap_rectangle, heatmap_polygon).
+"""
+import numpy as np
+from analysis import valid_spectra
+from parallel import with_progress
+from preprocessing import row_blocks, new_cube
+from profiling import profiled
+
+
+class RegionStats(object):
+    """Mean and standard deviation spectra of the pixels of a region"""
+
+    def __init__(self, wavenums, count, sums, squares, offset):
+        #: Wavenumber axis of the spectra
+        self.wavenums = wavenums
+        #: Number of spectra in the region
+        self.count = int(round(count))
+        n = max(count, 1)
+        #: Mean spectrum, zero for an empty region
+        self.mean = offset + sums / n if count else np.zeros_like(sums)
+        # Sums are of the spectra minus offset, which keeps the variance
+        # from cancelling against a large common background
+        variance = np.clip(squares / n - (sums / n) ** 2, 0, None)
+        #: Standard deviation of the spectra (population, ddof=0)
+        self.std = np.sqrt(variance)
+
+    def __repr__(self):
+        return "RegionStats({} spectra)".format(self.count)
+
+
+class SummedAreaTables(object):
+    """Summed-area tables of a cube, see summed_area_tables"""
+
+    def __init__(self, counts, sums, squares, offset):
+        #: (num_xs + 1, num_ys + 1) number of spectra at pixels i' < i, j' < j
+        self.counts = counts
+        #: (num_xs + 1, num_ys + 1, n_wavenums) sums of the spectra minus
+        #: offset at pixels i' < i, j' < j
+        self.sums = sums
+        #: As sums, of the squares
+        self.squares = squares
+        #: Spectrum subtracted before summing
+        self.offset = offset
+
+    def rectangle(self, rows, cols):
+        """Returns the count, sums and squares of the pixels i in range(*rows),
+        j in range(*cols)"""
+        (i0, i1), (j0, j1) = rows, cols
+
+        def total(table):
+            return table[i1, j1] - table[i0, j1] - table[i1, j0] + table[i0, j0]
+        return total(self.counts), total(self.sums), total(self.squares)
+
+
+@profiled()
+def summed_area_tables(collec, sums_file=None, squares_file=None, progress=None):
+    """
+    Builds the summed-area tables of the cube of collec, a block of X rows
+    at a time. The two tables are each the size of the cube; they are
+    memory-mapped from sums_file and squares_file if given.
+    progress(done, total) is called per block.
+    """
+    if collec.cube is None:
+        collec.build_cube()
+    blocks = row_blocks(collec)
+    n_wavenums = collec.cube.shape[2]
+    offset = np.zeros(n_wavenums)
+    for start, stop in blocks:
+        spectra, _ = valid_spectra(collec, start, stop)
+        if len(spectra):
+            offset = spectra.mean(axis=0)
+            break
+
+    shape = (collec.num_xs + 1, collec.num_ys + 1, n_wavenums)
+    # Always float64, the tables are differenced
+    sums = new_cube(collec, sums_file, shape, np.float64)
+    squares = new_cube(collec, squares_file, shape, np.float64)
+    counts = np.zeros(shape[:2])
+    counts[1:, 1:] = np.cumsum(np.cumsum(collec.mask, axis=0), axis=1)
+    for start, stop in with_progress(blocks, len(blocks), progress):
+        block = np.asarray(collec.cube[start:stop], dtype=np.float64) - offset
+        block[~collec.mask[start:stop]] = 0
+        # Rows start from the totals of the rows before the block
+        sums[start + 1:stop + 1, 1:] = (np.cumsum(np.cumsum(block, axis=1), axis=0) +
+                                        sums[start, 1:])
+        block *= block
+        squares[start + 1:stop + 1, 1:] = (np.cumsum(np.cumsum(block, axis=1), axis=0) +
+                                           squares[start, 1:])
+    if sums_file is not None:
+        sums.flush()
+    if squares_file is not None:
+        squares.flush()
+    return SummedAreaTables(counts, sums, squares, offset)
+
+
+def pixel_rectangle_stats(collec, rows, cols, progress=None):
+    """RegionStats of the pixels i in range(*rows), j in range(*cols), from
+    the summed-area tables of collec (built on first use)"""
+    tables = collec.summed_area_tables(progress)
+    rows = tuple(np.clip(rows, 0, collec.num_xs))
+    cols = tuple(np.clip(cols, 0, collec.num_ys))
+    count, sums, squares = tables.rectangle(rows, cols)
+    return RegionStats(np.array(collec.wavenums), count, sums, squares, tables.offset)
+
+
+@profiled()
+def mask_stats(collec, mask, progress=None):
+    """RegionStats of the pixels where the (num_xs, num_ys) mask is True,
+    reading only the X rows that hold some"""
+    if collec.cube is None:
+        collec.build_cube()
+    mask = mask & collec.mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    n_wavenums = collec.cube.shape[2]
+    count, sums, squares = 0, np.zeros(n_wavenums), np.zeros(n_wavenums)
+    offset = np.zeros(n_wavenums)
+    if len(rows):
+        offset = np.asarray(collec.cube[rows[0]][mask[rows[0]]][0], dtype=np.float64)
+        blocks = [(max(start, rows[0]), min(stop, rows[-1] + 1))
+                  for start, stop in row_blocks(collec) if start <= rows[-1] and stop > rows[0]]
+        for start, stop in with_progress(blocks, len(blocks), progress):
+            spectra = np.asarray(collec.cube[start:stop][mask[start:stop]],
+                                 dtype=np.float64) - offset
+            count += len(spectra)
+            sums += spectra.sum(axis=0)
+            squares += (spectra * spectra).sum(axis=0)
+    return RegionStats(np.array(collec.wavenums), count, sums, squares, offset)
+
+
+def rectangle_stats(collec, x_range, y_range, progress=None):
+    """RegionStats of the spectra with x_range[0] <= X <= x_range[1] and
+    y_range[0] <= Y <= y_range[1]. On a regular grid the rectangle is one
+    block of pixels, answered from the summed-area tables"""
+    (x0, x1), (y0, y1) = sorted(x_range), sorted(y_range)
+    grid = collec.grid
+    if grid.regular:
+        rows = (np.searchsorted(grid.xs, x0), np.searchsorted(grid.xs, x1, side='right'))
+        cols = (np.searchsorted(grid.unique_ys, y0),
+                np.searchsorted(grid.unique_ys, y1, side='right'))
+        return pixel_rectangle_stats(collec, rows, cols, progress)
+    inside = ((grid.point_xs >= x0) & (grid.point_xs <= x1) &
+              (grid.point_ys >= y0) & (grid.point_ys <= y1))
+    return mask_stats(collec, points_mask(collec, inside), progress)
+
+
+def points_mask(collec, selected):
+    """Pixel mask of the points of collec.grid where selected is True"""
+    grid = collec.grid
+    mask = np.zeros((collec.num_xs, collec.num_ys), dtype=bool)
+    mask[grid.pixel_i[selected], grid.pixel_j[selected]] = True
+    return mask
+
+
+def polygon_mask(collec, vertices, pixels=False):
+    """
+    Pixel mask of the spectra inside the polygon of (x, y) vertices, in X/Y
+    coordinates, or of the pixels whose (i, j) centres are inside if pixels
+    is True
+    """
+    from matplotlib.path import Path
+    path = Path(np.asarray(vertices, dtype=float))
+    if not pixels:
+        grid = collec.grid
+        return points_mask(collec, path.contains_points(
+            np.column_stack((grid.point_xs, grid.point_ys))))
+    # Only the pixels of the bounding box are tested
+    (i0, j0), (i1, j1) = np.floor(path.vertices.min(axis=0)), np.ceil(path.vertices.max(axis=0))
+    i0, i1 = int(min(max(i0, 0), collec.num_xs)), int(min(max(i1 + 1, 0), collec.num_xs))
+    j0, j1 = int(min(max(j0, 0), collec.num_ys)), int(min(max(j1 + 1, 0), collec.num_ys))
+    mask = np.zeros((collec.num_xs, collec.num_ys), dtype=bool)
+    i, j = np.mgrid[i0:i1, j0:j1]
+    centres = np.column_stack((i.ravel(), j.ravel()))
+    mask[i0:i1, j0:j1] = path.contains_points(centres).reshape(i.shape)
+    return mask
+
+
+def polygon_stats(collec, vertices, pixels=False, progress=None):
+    """RegionStats of the spectra inside a polygon, see polygon_mask"""
+    return mask_stats(collec, polygon_mask(collec, vertices, pixels), progress)
+
+
+def heatmap_rectangle(collec, x_range, y_range):
+    """Pixel ranges (rows, cols) of the pixels whose centres lie in a
+    rectangle drawn on the heatmap of collec (display x = i, y = num_ys - 1 - j)"""
+    (x0, x1), (y0, y1) = sorted(x_range), sorted(y_range)
+    rows = (int(np.ceil(x0)), int(np.floor(x1)) + 1)
+    cols = (int(np.ceil(collec.num_ys - 1 - y1)), int(np.floor(collec.num_ys - 1 - y0)) + 1)
+    return ((min(max(rows[0], 0), collec.num_xs), min(max(rows[1], 0), collec.num_xs)),
+            (min(max(cols[0], 0), collec.num_ys), min(max(cols[1], 0), collec.num_ys)))
+
+
+def heatmap_polygon(collec, vertices):
+    """(i, j) pixel vertices of a polygon drawn on the heatmap of collec"""
+    vertices = np.array(vertices, dtype=float)
+    vertices[:, 1] = collec.num_ys - 1 - vertices[:, 1]
+    return vertices
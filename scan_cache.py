@@ -0,0 +1,172 @@
+"""
+On-disk cache of parsed scan directories.
+
+The spectra of a directory are stored in a single uncompressed .npz sidecar
+file next to the data, together with a manifest of the name, size and mtime
+of every .txt file. Reopening an unchanged directory loads the sidecar
+instead of reparsing the text files; any change to the files invalidates it.
+
+Directories too big for memory are loaded out of core instead: the spectra
+go into a memory-mapped cube file next to the data, which doubles as the
+cache for that directory.
+
+Compact loads (float32 cube, no SpectrumData objects) read the sidecar but
+never write it, so that it always holds the spectra at full precision.
+"""
+from __future__ import print_function
+import json
+import os
+import numpy as np
+from pyspec import (SpectrumData, SpectrumCollection, from_area_dir, from_line_file,
+                    axes_filename, with_dense_cube)
+from profiling import profiled
+
+#: Name of the sidecar file written into the scan directory
+CACHE_FILE = ".pyspectrum_cache.npz"
+
+#: Name of the memory-mapped cube written by out-of-core loads
+CUBE_FILE = ".pyspectrum_cube.npy"
+
+#: Manifest of the files the out-of-core cube was built from
+CUBE_MANIFEST_FILE = ".pyspectrum_cube.json"
+
+#: Directories whose .txt files add up to more than this are loaded out of core
+OUT_OF_CORE_BYTES = 4 * 1024 ** 3
+
+#: Bumped whenever the layout of the sidecar file changes
+CACHE_VERSION = 1
+
+
+def scan_files(path):
+    """Returns the sorted names of the spectrum .txt files in path"""
+    return [f for f in sorted(os.listdir(path)) if f.endswith(".txt")]
+
+
+def build_manifest(path, file_list, **options):
+    """Describes the files of a scan directory and the parse options, the
+    cache is only valid while this stays the same"""
+    files = []
+    for name in file_list:
+        stat = os.stat(os.path.join(path, name))
+        files.append([name, stat.st_size, stat.st_mtime])
+    return {"version": CACHE_VERSION, "files": files, "options": options}
+
+
+def save_cache(path, collec, manifest):
+    """Writes the spectra of collec and the manifest into the sidecar file"""
+    spectra = list(collec.spectra)
+    lengths = np.array([spectrum.info.shape[1] for spectrum in spectra], dtype=np.int64)
+    if spectra:
+        points = np.concatenate([spectrum.info_flipped for spectrum in spectra])
+    else:
+        points = np.empty((0, 2))
+    tmp_name = os.path.join(path, CACHE_FILE + ".tmp.npz")
+    np.savez(tmp_name,
+             manifest=np.array(json.dumps(manifest)),
+             xs=np.array([spectrum.x for spectrum in spectra]),
+             ys=np.array([spectrum.y for spectrum in spectra]),
+             lengths=lengths,
+             points=points)
+    # Replace in one step, so readers never see a half written cache
+    getattr(os, "replace", os.rename)(tmp_name, os.path.join(path, CACHE_FILE))
+
+
+def load_cache(path, manifest):
+    """Returns the cached SpectrumCollection for path, or None if there is no
+    cache or it was written for a different manifest"""
+    cache_name = os.path.join(path, CACHE_FILE)
+    if not os.path.exists(cache_name):
+        return None
+    try:
+        with np.load(cache_name) as cached:
+            if json.loads(str(cached["manifest"])) != manifest:
+                return None
+            xs = cached["xs"]
+            ys = cached["ys"]
+            lengths = cached["lengths"]
+            points = cached["points"]
+    except (IOError, ValueError, KeyError):
+        # Unreadable or foreign file, parse again and overwrite it
+        return None
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    spectra = [SpectrumData(x, y, points[offsets[k]:offsets[k + 1]])
+               for k, (x, y) in enumerate(zip(xs.tolist(), ys.tolist()))]
+    return SpectrumCollection.from_spectrum_data_list(spectra)
+
+
+def load_cube(path, manifest, linescan=False, filter_negative=True, use_cache=True,
+              verbose=False, processes=None, compact=False, progress=None):
+    """Loads a scan directory into a memory-mapped cube file next to the
+    data, reopening the existing cube if it was built from the same files
+    (and with the same compact setting)"""
+    cube_file = os.path.join(path, CUBE_FILE)
+    if compact:
+        manifest = dict(manifest, compact=True)
+    manifest_file = os.path.join(path, CUBE_MANIFEST_FILE)
+    if use_cache and os.path.exists(manifest_file) and os.path.exists(axes_filename(cube_file)):
+        with open(manifest_file) as cached:
+            if json.load(cached) == manifest:
+                if verbose:
+                    print("Opened cached cube {}".format(cube_file))
+                return SpectrumCollection.open_cube(cube_file)
+    if os.path.exists(manifest_file):
+        # A half rewritten cube must never look valid
+        os.remove(manifest_file)
+    if linescan:
+        collec = from_line_file(os.path.join(path, manifest["files"][0][0]), filter_negative,
+                                cube_file=cube_file, compact=compact, progress=progress)
+    else:
+        collec = from_area_dir(path, filter_negative, processes, verbose=verbose,
+                               cube_file=cube_file, compact=compact, progress=progress)
+    with open(manifest_file, "w") as cached:
+        json.dump(manifest, cached)
+    return collec
+
+
+@profiled()
+def load_scan(path, linescan=False, filter_negative=True, use_cache=True, verbose=False,
+              out_of_core=None, processes=None, compact=False, progress=None):
+    """
+    Loads an area scan directory, or the linescan file in it, through the
+    sidecar cache. The cube is built on a common wavenumber axis, resampling
+    the spectra if their axes differ.
+
+    With out_of_core the cube is memory-mapped from disk (see load_cube);
+    by default this is chosen for directories over OUT_OF_CORE_BYTES.
+    Area scan files are parsed in processes worker processes (see
+    from_area_dir). With compact the collection is loaded in compact
+    storage, see SpectrumCollection.compact. progress(done, total) is
+    called while files are parsed.
+    """
+    file_list = scan_files(path)
+    manifest = build_manifest(path, file_list, linescan=linescan,
+                              filter_negative=filter_negative)
+    if out_of_core is None:
+        out_of_core = sum(size for _, size, _ in manifest["files"]) > OUT_OF_CORE_BYTES
+    if out_of_core:
+        return load_cube(path, manifest, linescan, filter_negative, use_cache, verbose,
+                         processes, compact, progress)
+    collec = load_cache(path, manifest) if use_cache else None
+    if collec is not None:
+        if verbose:
+            print("Loaded {} spectra from cache".format(len(collec.spectra)))
+    elif compact:
+        if linescan:
+            return from_line_file(os.path.join(path, file_list[0]), filter_negative,
+                                  compact=True, progress=progress)
+        return from_area_dir(path, filter_negative, processes, verbose=verbose, compact=True,
+                             progress=progress)
+    else:
+        if linescan:
+            collec = from_line_file(os.path.join(path, file_list[0]), filter_negative,
+                                    progress=progress)
+        else:
+            collec = from_area_dir(path, filter_negative, processes, dense=False,
+                                   verbose=verbose, progress=progress)
+        if use_cache:
+            try:
+                save_cache(path, collec, manifest)
+            except (IOError, OSError):
+                # Read-only data directories simply are not cached
+                pass
+    return with_dense_cube(collec, compact)
@@ -1,27 +1,55 @@
-
 from PySide import QtGui, QtCore
-import os
+from collections import OrderedDict
+import threading
+import numpy as np
+from export import colormap_lut, render_slice
+from profiling import stage
+from pyramid import level_for_view, num_levels
 
-class ImageStack(QtGui.QWidget):
-    def __init__(self, spectrum_collec, path, parent=None):
-        QtGui.QWidget.__init__(self, parent)
+#: Number of slice pixmaps kept in the LRU cache
+CACHE_SIZE = 64
+
+#: Number of slices on each side of the current one rendered in the background
+PREFETCH = 4
 
-        self.path = path
+#: Slices are upscaled (nearest neighbour) until their longer side reaches this
+DISPLAY_SIZE = 400
 
-        self.image_files = [f for f in sorted(os.listdir(path)) if f.endswith(".tiff")]
-        self.image_files = self.get_float()
+class ImageStack(QtGui.QWidget):
+    """Scrollable stack of the single-wavenumber images of a collection,
+    rendered straight from its data rather than from exported TIFFs"""
+
+    def __init__(self, spectrum_collec, linescan=False, cmap='gray', parent=None):
+        QtGui.QWidget.__init__(self, parent)
 
-        self.button = QtGui.QPushButton('Images')
-        self.button.clicked.connect(self.show_images)
+        self.my_collec = spectrum_collec
+        self.linescan = linescan
+        self.lut = colormap_lut(cmap)
+        self.wavenums = np.sort(self.my_collec.get_wavenums())
+        #: Pyramid level the slices are rendered from, the coarsest that
+        #: still fills DISPLAY_SIZE
+        self.level = 0
+        if not linescan and self.my_collec.cube is not None:
+            num_xs, num_ys = self.my_collec.num_xs, self.my_collec.num_ys
+            self.level = level_for_view(num_xs, num_ys, DISPLAY_SIZE, DISPLAY_SIZE,
+                                        num_levels(num_xs, num_ys))
+
+        # LRU cache of slice index -> QPixmap, most recently shown last
+        self.pixmaps = OrderedDict()
+        # Slices rendered by the prefetch thread, waiting to become pixmaps
+        self.rendered = {}
+        self.rendered_lock = threading.Lock()
+        self.prefetch_center = 0
+        self.prefetcher = None
 
         self.slider = QtGui.QSlider(QtCore.Qt.Horizontal)
         self.slider.setMinimum(0)
-        self.slider.setMaximum(len(self.image_files)-1)
+        self.slider.setMaximum(len(self.wavenums)-1)
         self.slider.setTickInterval(1)
         self.curr_img_indx = self.slider.sliderPosition()
         self.slider.valueChanged.connect(self.show_images)
 
-        # text next to slider showing file name
+        # text next to slider showing the wavenumber
         self.sld_text = QtGui.QLabel()
         self.sld_text.setStyleSheet('background-color: white')
 
@@ -35,16 +63,11 @@ class ImageStack(QtGui.QWidget):
         self.gbox_sld.setLayout(sld_text_box)
         self.gbox_sld.setContentsMargins(0, 0, 0, 0)
 
-        self.my_collec = spectrum_collec
-
-        # initialize image and label for gui
-        self.my_image = QtGui.QImage()
+        # initialize label for gui, showing the first image (once the level
+        # is built, see PlotDisplay.img_stack, if it is not the map itself)
         self.label = QtGui.QLabel()
-
-        # set label to show first image
-        if len(self.image_files) > 0:
-            self.my_image.load(path + '/' + self.image_files[0])
-            self.label.setPixmap(QtGui.QPixmap.fromImage(self.my_image))
+        if len(self.wavenums) > 0 and self.level == 0:
+            self.show_images()
 
         layout = QtGui.QVBoxLayout()
         layout.addWidget(self.label)
@@ -52,19 +75,74 @@ class ImageStack(QtGui.QWidget):
         self.setLayout(layout)
 
     def show_images(self):
-        curr_pos = self.slider.sliderPosition()
-        curr_img = self.image_files[curr_pos]
-        self.sld_text.setText(str(self.image_files[curr_pos]))
-        self.my_image.load(self.path + '/' + curr_img)
-        self.label.setPixmap(QtGui.QPixmap.fromImage(self.my_image))
-
-    def get_float(self):
-        sorted_img_files = []
-        for img in self.image_files:
-            basename = img.rpartition('.')
-            sorted_img_files.append(basename[0])
-        sorted_img_files.sort(key=float)
-        return sorted_img_files
-
-
-
+        with stage("gui.ImageStack.show_images"):
+            curr_pos = self.slider.sliderPosition()
+            self.sld_text.setText(str(self.wavenums[curr_pos]))
+            self.label.setPixmap(self.get_pixmap(curr_pos))
+            self.prefetch(curr_pos)
+
+    def render(self, indx):
+        """Renders slice indx into the uint8 image shown by the label"""
+        with stage("gui.ImageStack.render"):
+            source = self.my_collec.pyramid(self.level)
+            img_array = source.get_img_array(self.wavenums[indx], self.linescan)
+            scale = max(1, DISPLAY_SIZE // max(img_array.shape))
+            return render_slice(img_array, self.lut, scale, 0.1 if self.linescan else None)
+
+    def get_pixmap(self, indx):
+        """Returns the pixmap of slice indx, from the cache when possible"""
+        if indx in self.pixmaps:
+            # Mark as most recently used
+            pixmap = self.pixmaps.pop(indx)
+        else:
+            with self.rendered_lock:
+                img = self.rendered.pop(indx, None)
+            if img is None:
+                img = self.render(indx)
+            pixmap = to_pixmap(img)
+        self.pixmaps[indx] = pixmap
+        while len(self.pixmaps) > CACHE_SIZE:
+            self.pixmaps.popitem(last=False)
+        return pixmap
+
+    def prefetch(self, indx):
+        """Renders the slices next to indx in a background thread. Pixmaps
+        can only be made on the GUI thread, so the thread stops at the
+        rendered images and get_pixmap converts them when they are shown"""
+        self.prefetch_center = indx
+        if self.prefetcher is None or not self.prefetcher.is_alive():
+            self.prefetcher = threading.Thread(target=self._prefetch_loop)
+            self.prefetcher.daemon = True
+            self.prefetcher.start()
+
+    def _prefetch_loop(self):
+        while True:
+            # Re-read the center every step, the slider may have moved on
+            center = self.prefetch_center
+            wanted = [center + step * sign for step in range(1, PREFETCH + 1) for sign in (1, -1)]
+            wanted = [k for k in wanted if 0 <= k < len(self.wavenums)]
+            with self.rendered_lock:
+                # Forget slices the slider has moved away from
+                for k in list(self.rendered):
+                    if k not in wanted:
+                        del self.rendered[k]
+                todo = [k for k in wanted if k not in self.rendered and k not in self.pixmaps]
+            if not todo:
+                return
+            img = self.render(todo[0])
+            with self.rendered_lock:
+                self.rendered[todo[0]] = img
+
+
+def to_pixmap(img):
+    """Converts a uint8 greyscale (rows, cols) or RGB (rows, cols, 3) image
+    into a QPixmap"""
+    img = np.ascontiguousarray(img)
+    height, width = img.shape[:2]
+    if img.ndim == 2:
+        qimage = QtGui.QImage(img.tobytes(), width, height, width, QtGui.QImage.Format_Indexed8)
+        qimage.setColorTable([QtGui.qRgb(level, level, level) for level in range(256)])
+    else:
+        qimage = QtGui.QImage(img.tobytes(), width, height, 3 * width, QtGui.QImage.Format_RGB888)
+    # Copy so the image no longer refers to the temporary buffer
+    return QtGui.QPixmap.fromImage(qimage.copy())
@@ -0,0 +1,88 @@
+"""
+Runs long operations off the Qt event loop.
+
+run_task calls a function in a background thread, shows its progress in a
+cancellable progress dialog and hands the result back on the GUI thread.
+The function must accept a progress keyword (see parallel.with_progress);
+cancelling makes the next progress call raise Cancelled inside the worker.
+"""
+import threading
+import traceback
+from PySide import QtGui, QtCore
+
+#: Steps of the progress dialog
+PROGRESS_STEPS = 1000
+
+#: Tasks still running, kept referenced so they are not garbage collected
+_running = set()
+
+class Cancelled(Exception):
+    """Raised in the worker thread when the user cancels the task"""
+
+
+class Task(QtCore.QThread):
+    """Background thread running func(*args, progress=..., **kwargs)"""
+
+    #: Progress in PROGRESS_STEPS steps
+    progressed = QtCore.Signal(int)
+    #: Return value of func
+    succeeded = QtCore.Signal(object)
+    #: Formatted traceback of the exception raised by func
+    failed = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+
+    def __init__(self, func, *args, **kwargs):
+        QtCore.QThread.__init__(self)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel_event = threading.Event()
+
+    def report(self, done, total):
+        """Progress callback handed to func"""
+        if self.cancel_event.is_set():
+            raise Cancelled()
+        self.progressed.emit(int(PROGRESS_STEPS * done / max(total, 1)))
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        try:
+            result = self.func(*self.args, progress=self.report, **self.kwargs)
+        except Cancelled:
+            self.cancelled.emit()
+        except Exception:
+            self.failed.emit(traceback.format_exc())
+        else:
+            self.succeeded.emit(result)
+
+
+def run_task(parent, label, on_finished, func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) in a Task with a progress dialog, then calls
+    on_finished(result) on the GUI thread (if given). Errors are shown in a
+    message box. Returns the Task, which starts once control is back in the
+    event loop, so callers can still connect to its signals.
+    """
+    task = Task(func, *args, **kwargs)
+    dialog = QtGui.QProgressDialog(label, "Cancel", 0, PROGRESS_STEPS, parent)
+    dialog.setWindowModality(QtCore.Qt.WindowModal)
+    # Quick tasks finish without the dialog ever appearing
+    dialog.setMinimumDuration(500)
+    dialog.setValue(0)
+
+    task.progressed.connect(dialog.setValue)
+    dialog.canceled.connect(task.cancel)
+    if on_finished is not None:
+        task.succeeded.connect(on_finished)
+    task.failed.connect(lambda message: QtGui.QMessageBox.critical(parent, "Error", message))
+
+    def cleanup():
+        dialog.reset()
+        _running.discard(task)
+    task.finished.connect(cleanup)
+
+    _running.add(task)
+    QtCore.QTimer.singleShot(0, task.start)
+    return task